@@ -0,0 +1,429 @@
+'''
+Benchmarks of relaying across tree shapes.
+Every node runs in its own process (so that CPU and RSS are per node) and the benchmark
+drives them through pipes. It reports end-to-end latency percentiles by hop count,
+messages/s and bytes/s at saturation, CPU and RSS per node, the fan-out cost at hubs
+and the time the tree takes to recover from the loss of a relay node as JSON.
+'''
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import typing
+
+import node
+
+SHAPES = ('chain', 'star', 'balanced')
+SETTLE_SECONDS = 0.5  # lets the handshakes finish before measuring
+DELIVERY_TIMEOUT_SECONDS = 60
+POLL_SECONDS = 0.1
+PERCENTILES = (50, 90, 99)
+REPAIR_PROBE_INTERVAL_SECONDS = 0.005
+REPAIR_PROBE_SECONDS = 10  # the longest the root keeps probing for a repaired tree
+
+def make_parents(shape: str, nodes: int, fanout: int) -> list[int]:
+    '''
+    The inviter of every node (None for the root, node 0).
+    '''
+    parents = [None]
+    for i in range(1, nodes):
+        if shape == 'chain':
+            parents.append(i - 1)
+        elif shape == 'star':
+            parents.append(0)
+        else:
+            parents.append((i - 1) // fanout)
+    return parents
+
+def make_hops(parents: list[int]) -> list[list[int]]:
+    '''
+    The number of hops between every two nodes of the tree.
+    '''
+    adjacency = [[] for _ in parents]
+    for child, parent in enumerate(parents):
+        if parent is not None:
+            adjacency[child].append(parent)
+            adjacency[parent].append(child)
+    hops = []
+    for source in range(len(parents)):
+        distances = [None] * len(parents)
+        distances[source] = 0
+        frontier = [source]
+        while frontier:
+            next_frontier = []
+            for u in frontier:
+                for v in adjacency[u]:
+                    if distances[v] is None:
+                        distances[v] = distances[u] + 1
+                        next_frontier.append(v)
+            frontier = next_frontier
+        hops.append(distances)
+    return hops
+
+def percentiles(samples: list[int]) -> dict:
+    '''
+    Summarizes nanosecond samples in microseconds.
+    '''
+    samples = sorted(samples)
+    summary = {'count': len(samples)}
+    for p in PERCENTILES:
+        index = min(len(samples) - 1, (len(samples) * p) // 100)
+        summary[f'p{p}_us'] = round(samples[index] / 1000, 1)
+    summary['max_us'] = round(samples[-1] / 1000, 1)
+    return summary
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class Probe:
+    '''
+    The measurements of one node, taken from the messages it receives.
+    Benchmark messages are "latency <origin> <monotonic ns>", "saturation <padding>"
+    or "repair <monotonic ns>" (probes sent after a relay node is stopped).
+    '''
+    def __init__(self, index: int):
+        self.index = index
+        self.sender_id = None  # the node's own messages are skipped
+        self.latencies = {}  # origin index -> nanoseconds
+        self.saturation_messages = 0
+        self.saturation_bytes = 0
+        self.saturation_last_ns = None
+        self.repair_first_ns = None  # when the first repair probe arrived
+
+    def on_message(self, packet: node.Packet) -> None:
+        now = time.monotonic_ns()
+        payload = packet.payload()
+        if packet.kind() != node.FRAME_MESSAGE:
+            return
+        sender_id, _, _, name_length = node.MESSAGE_HEADER.unpack_from(payload)
+        if sender_id == self.sender_id:
+            return
+        text = payload[node.MESSAGE_HEADER.size + name_length:]
+        if text[:8] == b'latency ':
+            _, origin, sent_ns = bytes(text).split()
+            self.latencies.setdefault(int(origin), []).append(now - int(sent_ns))
+        elif text[:11] == b'saturation ':
+            self.saturation_messages += 1
+            self.saturation_bytes += len(packet.frame)
+            self.saturation_last_ns = now
+        elif text[:7] == b'repair ' and self.repair_first_ns is None:
+            self.repair_first_ns = now
+
+    def report(self, the_node: node.Node) -> dict:
+        return {'index': self.index,
+                'latencies': self.latencies,
+                'saturation_messages': self.saturation_messages,
+                'saturation_bytes': self.saturation_bytes,
+                'saturation_last_ns': self.saturation_last_ns,
+                'repair_first_ns': self.repair_first_ns,
+                'repairs': the_node.repair_counter,
+                'last_repair_seconds': the_node.last_repair_seconds,
+                'neighbors': len(the_node.neighbors),
+                'cpu_seconds': cpu_seconds(),
+                'rss_peak_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'read_bytes': the_node.read_counter,
+                'write_bytes': the_node.write_counter}
+
+async def send_latency_messages(the_node: node.Node, index: int,
+                                count: int, interval_seconds: float) -> None:
+    for _ in range(count):
+        the_node.send(f'latency {index} {time.monotonic_ns()}')
+        await asyncio.sleep(interval_seconds)
+
+async def send_saturation_messages(the_node: node.Node, count: int, message_bytes: int) -> None:
+    '''
+    Sends as fast as the tree takes the messages: the origin waits while
+    a neighbor is congested instead of growing its queues without bound.
+    '''
+    text = 'saturation ' + 'x' * max(0, message_bytes - len('saturation '))
+    for i in range(count):
+        while the_node.congested_neighbors:
+            await asyncio.sleep(0.001)
+        the_node.send(text)
+        if i % 64 == 63:
+            await asyncio.sleep(0)  # lets the loop flush
+
+async def send_repair_probes(the_node: node.Node) -> None:
+    for _ in range(int(REPAIR_PROBE_SECONDS / REPAIR_PROBE_INTERVAL_SECONDS)):
+        the_node.send(f'repair {time.monotonic_ns()}')
+        await asyncio.sleep(REPAIR_PROBE_INTERVAL_SECONDS)
+
+def worker(index: int, port: int, inviter_port: int, nodes: int, connection) -> None:
+    '''
+    Runs one node and follows the commands of the benchmark.
+    Joins are never redirected (with a policy allowing "nodes" children and depth),
+    so the tree has the shape the hops are computed from.
+    '''
+    sys.stderr = open(os.devnull, 'w')  # the nodes' system messages are not measured
+
+    async def run() -> None:
+        loop = asyncio.get_running_loop()
+        probe = Probe(index)
+        inviter_address = None if inviter_port is None else ('localhost', inviter_port)
+        the_node = node.Node(f'n{index}', ('localhost', port), inviter_address,
+                             on_message = probe.on_message,
+                             join_policy = node.JoinPolicy(nodes, nodes))
+        probe.sender_id = the_node.origin.sender_id
+        await the_node.start()
+        stopped = loop.create_future()
+        tasks = set()
+
+        def on_command() -> None:
+            command, *args = connection.recv()
+            if command == 'latency':
+                task = loop.create_task(send_latency_messages(the_node, index, *args))
+            elif command == 'saturation':
+                task = loop.create_task(send_saturation_messages(the_node, *args))
+            elif command == 'repair':
+                task = loop.create_task(send_repair_probes(the_node))
+            elif command == 'report':
+                connection.send(probe.report(the_node))
+                return
+            else:
+                stopped.set_result(None)
+                return
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        loop.add_reader(connection.fileno(), on_command)
+        connection.send('ready')
+        await stopped
+        loop.remove_reader(connection.fileno())
+        await the_node.close()
+        connection.send(time.monotonic_ns())  # when the node was closed
+
+    asyncio.run(run())
+    connection.close()
+
+class Tree:
+    '''
+    The processes of one tree and the pipes to them.
+    '''
+    def __init__(self, shape: str, nodes: int, fanout: int, base_port: int):
+        self.shape = shape
+        self.parents = make_parents(shape, nodes, fanout)
+        self.hops = make_hops(self.parents)
+        self.connections = []
+        self.processes = []
+        self.stopped = set()
+        context = multiprocessing.get_context('fork')
+        for i, parent in enumerate(self.parents):  # a parent listens before its children join
+            ours, theirs = context.Pipe()
+            inviter_port = None if parent is None else base_port + parent
+            process = context.Process(target = worker,
+                                      args = (i, base_port + i, inviter_port, nodes, theirs))
+            process.start()
+            theirs.close()
+            if ours.recv() != 'ready':
+                raise RuntimeError(f'node {i} failed to start')
+            self.connections.append(ours)
+            self.processes.append(process)
+        time.sleep(SETTLE_SECONDS)
+
+    def command(self, i: int, *command) -> None:
+        self.connections[i].send(command)
+
+    def live(self) -> list[int]:
+        return [i for i in range(len(self.connections)) if i not in self.stopped]
+
+    def reports(self) -> list[dict]:
+        for i in self.live():
+            self.connections[i].send(('report',))
+        return [self.connections[i].recv() for i in self.live()]
+
+    def wait_for(self, done) -> list[dict]:
+        deadline = time.monotonic() + DELIVERY_TIMEOUT_SECONDS
+        while True:
+            reports = self.reports()
+            if done(reports) or time.monotonic() > deadline:
+                return reports
+            time.sleep(POLL_SECONDS)
+
+    def stop(self, i: int) -> int:
+        '''
+        Returns when the node was closed (in monotonic nanoseconds).
+        '''
+        self.connections[i].send(('stop',))
+        closed_ns = self.connections[i].recv()
+        self.stopped.add(i)
+        return closed_ns
+
+    def join(self) -> None:
+        for process in self.processes:
+            process.join()
+
+    def close(self) -> None:
+        for i in self.live():
+            self.stop(i)
+        self.join()
+        for connection in self.connections:
+            connection.close()
+
+def measure_latency(tree: Tree, origins: list[int], count: int, interval_seconds: float) -> dict:
+    for origin in origins:
+        tree.command(origin, 'latency', count, interval_seconds)
+    expected = count * len(origins)
+
+    def done(reports: list[dict]) -> bool:
+        return all(sum(len(samples) for origin, samples in report['latencies'].items()) ==
+                   expected - (count if report['index'] in origins else 0)
+                   for report in reports)
+
+    reports = tree.wait_for(done)
+    by_hops = {}
+    for report in reports:
+        for origin, samples in report['latencies'].items():
+            by_hops.setdefault(tree.hops[origin][report['index']], []).extend(samples)
+    return {str(hops): percentiles(by_hops[hops]) for hops in sorted(by_hops)}
+
+def measure_saturation(tree: Tree, origin: int, count: int, message_bytes: int) -> tuple:
+    before = tree.reports()
+    start_ns = time.monotonic_ns()
+    tree.command(origin, 'saturation', count, message_bytes)
+
+    def done(reports: list[dict]) -> bool:
+        return all(report['saturation_messages'] >= count
+                   for report in reports if report['index'] != origin)
+
+    after = tree.wait_for(done)
+    receivers = [report for report in after if report['index'] != origin]
+    last_ns = max(report['saturation_last_ns'] or start_ns for report in receivers)
+    seconds = max(1e-9, (last_ns - start_ns) / 1e9)
+    delivered = sum(report['saturation_messages'] for report in receivers)
+    delivered_bytes = sum(report['saturation_bytes'] for report in receivers)
+    saturation = {'origin': origin,
+                  'messages': count,
+                  'message_bytes': message_bytes,
+                  'seconds': round(seconds, 4),
+                  'complete': delivered == count * len(receivers),
+                  'messages_per_second': round(count / seconds, 1),
+                  'delivered_messages_per_second': round(delivered / seconds, 1),
+                  'delivered_bytes_per_second': round(delivered_bytes / seconds, 1)}
+    nodes = []
+    for previous, report in zip(before, after, strict = True):
+        cpu = report['cpu_seconds'] - previous['cpu_seconds']
+        nodes.append({'index': report['index'],
+                      'neighbors': report['neighbors'],
+                      'hops_from_origin': tree.hops[origin][report['index']],
+                      'cpu_seconds': round(report['cpu_seconds'], 4),
+                      'saturation_cpu_seconds': round(cpu, 4),
+                      'saturation_cpu_us_per_message': round(cpu * 1e6 / count, 2),
+                      'rss_peak_kib': report['rss_peak_kib'],
+                      'read_bytes': report['read_bytes'],
+                      'write_bytes': report['write_bytes']})
+    return saturation, nodes
+
+def fanout_cost(nodes: list[dict], count: int) -> list[dict]:
+    '''
+    The relaying cost of the nodes with the most neighbors:
+    CPU per message and per copy sent (a relay sends one copy to every other neighbor).
+    '''
+    most = max(entry['neighbors'] for entry in nodes)
+    hubs = []
+    for entry in nodes:
+        if entry['neighbors'] == most and most > 1:
+            copies = (entry['neighbors'] - (0 if entry['hops_from_origin'] == 0 else 1)) * count
+            hubs.append({'index': entry['index'],
+                         'neighbors': entry['neighbors'],
+                         'cpu_us_per_message': entry['saturation_cpu_us_per_message'],
+                         'cpu_us_per_copy':
+                             round(entry['saturation_cpu_seconds'] * 1e6 / max(1, copies), 2)})
+    return hubs
+
+def measure_repair(tree: Tree) -> typing.Union[None, dict]:
+    '''
+    Stops the non-root node with the most children and measures how long its descendants
+    take to receive messages from the root again.
+    '''
+    children = [0] * len(tree.parents)
+    for parent in tree.parents[1:]:
+        children[parent] += 1
+    victim = max(range(1, len(tree.parents)), key = lambda i: children[i])
+    if children[victim] == 0:
+        return None  # no relay node besides the root
+    descendants = [i for i in range(len(tree.parents))
+                   if tree.hops[0][i] > tree.hops[0][victim] and
+                   tree.hops[0][i] == tree.hops[0][victim] + tree.hops[victim][i]]
+    stopped_ns = tree.stop(victim)
+    tree.command(0, 'repair')
+
+    def done(reports: list[dict]) -> bool:
+        return all(report['repair_first_ns'] is not None for report in reports
+                   if report['index'] != 0)
+
+    reports = {report['index']: report for report in tree.wait_for(done)}
+    recovered = [(reports[i]['repair_first_ns'] - stopped_ns) / 1e6 for i in descendants
+                 if reports[i]['repair_first_ns'] is not None]
+    repairs = [reports[i]['last_repair_seconds'] * 1000 for i in descendants
+               if reports[i]['repairs']]
+    return {'stopped_node': victim,
+            'orphans': children[victim],
+            'descendants': len(descendants),
+            'recovered': len(recovered),
+            'reconnections': len(repairs),
+            'max_reconnect_ms': round(max(repairs, default = 0), 2),
+            'median_time_to_recover_ms': round(sorted(recovered)[len(recovered) // 2], 2)
+                                         if recovered else None,
+            'max_time_to_recover_ms': round(max(recovered), 2) if recovered else None}
+
+def run(shape: str, arguments: argparse.Namespace, base_port: int) -> dict:
+    tree = Tree(shape, arguments.nodes, arguments.fanout, base_port)
+    try:
+        origins = sorted(set(arguments.origins or (0, arguments.nodes - 1)))
+        latency = measure_latency(tree, origins, arguments.latency_messages,
+                                  arguments.latency_interval_ms / 1000)
+        saturation, nodes = measure_saturation(tree, 0, arguments.saturation_messages,
+                                               arguments.message_bytes)
+        repair = measure_repair(tree)
+    finally:
+        tree.close()
+    return {'shape': shape,
+            'nodes': arguments.nodes,
+            'latency_origins': origins,
+            'latency_by_hops': latency,
+            'saturation': saturation,
+            'per_node': nodes,
+            'hubs': fanout_cost(nodes, arguments.saturation_messages),
+            'repair': repair}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--shape', choices = SHAPES, nargs = '+', default = list(SHAPES))
+    parser.add_argument('--nodes', type = int, default = 15)
+    parser.add_argument('--fanout', type = int, default = 2,
+                        help = 'the number of children per node of a balanced tree')
+    parser.add_argument('--latency-messages', type = int, default = 200,
+                        help = 'messages sent from each latency origin')
+    parser.add_argument('--origins', type = int, nargs = '+', metavar = 'INDEX',
+                        help = 'the nodes the latency messages are sent from '
+                               '(default: the root and the last node)')
+    parser.add_argument('--latency-interval-ms', type = float, default = 2)
+    parser.add_argument('--saturation-messages', type = int, default = 20000,
+                        help = 'messages the root sends as fast as the tree takes them')
+    parser.add_argument('--message-bytes', type = int, default = 100)
+    parser.add_argument('--base-port', type = int, default = 20000)
+    parser.add_argument('--output', help = 'a file for the JSON results (default: stdout)')
+    arguments = parser.parse_args()
+    if arguments.nodes < 2:
+        sys.exit('--nodes must be at least 2')
+    if arguments.origins and not all(0 <= origin < arguments.nodes for origin in arguments.origins):
+        sys.exit('--origins must be node indexes below --nodes')
+    results = {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'python': sys.version.split()[0],
+               'cpus': os.cpu_count(),
+               'config': vars(arguments),
+               'runs': []}
+    for i, shape in enumerate(arguments.shape):
+        results['runs'].append(run(shape, arguments, arguments.base_port + i * arguments.nodes))
+    text = json.dumps(results, indent = 2) + '\n'
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
@@ -1,6 +1,20 @@
+import argparse
+import asyncio
+import bisect
+import collections
 import datetime
-import select
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import mmap
+import os
+import random
+import selectors
+import signal
 import socket
+import struct
 import sys
 import threading
 import time
@@ -11,13 +25,107 @@ try:
 except ModuleNotFoundError:
     pass
 import typing
+import zlib
 
 # TODO: reduce the number of global variables
 SOCKET_CONNECTION_TIMEOUT_SECONDS = 10
-SOCKET_OPERATION_TIMEOUT_SECONDS = 0.1
-SELECT_TIMEOUT_SECONDS = 0.1
 PACKET_LENGTH_BYTES = 128
-HALTED = False
+READ_BUFFER_INITIAL_BYTES = 4096  # read buffers double when they are mostly full
+SEND_BATCH_CHUNKS = 512  # the most chunks one "sendmsg" call gathers (well below IOV_MAX)
+QUEUE_POLICIES = ('backpressure', 'drop-oldest', 'drop-newest', 'disconnect')
+RECEIVES_PER_ROUND = 16  # bounds the time spent on one busy neighbor before serving others
+# protocol v1 (legacy): fixed-length packets of PACKET_LENGTH_BYTES
+# protocol v2 (framed): frames of a FRAME_HEADER (payload length and frame kind) and a payload
+PROTOCOL_LEGACY = 1
+PROTOCOL_FRAMED = 2
+FRAME_HEADER = struct.Struct('!IB')
+FRAME_TEXT = 1  # plain text (from legacy nodes)
+FRAME_MESSAGE = 2  # a MESSAGE_HEADER, the sender name, and the text
+FRAME_CONTROL = 3  # a CONTROL_HEADER and a JSON body, for one link only (never relayed)
+FRAME_TRANSFER = 4  # a TRANSFER_HEADER and a part of a file transfer
+# a MESSAGE_HEADER, the sender name, COMPRESSED_LENGTH and the text compressed by its origin
+FRAME_COMPRESSED = 5
+CONTROL_HEADER = struct.Struct('!B')  # control type
+# {"address": the sender's listening address, "extra": an extra link or not,
+#  "size" and "height": the sender's subtree, "redirects": how often it has been redirected}
+CONTROL_JOIN = 1
+# {"ancestors": the listening addresses above the receiver, nearest first,
+#  "depth": the depth of the sender (0 for the root)}
+CONTROL_ANCESTORS = 2
+CONTROL_SIBLINGS = 3  # {"siblings": the listening addresses of the children that joined earlier}
+CONTROL_SUBTREE = 4  # {"size": the number of nodes, "height": the height} of the sender's subtree
+CONTROL_REDIRECT = 5  # {"address": where the receiver should join instead}
+CONTROL_CATCHUP = 6  # {"since": epoch milliseconds}: replay the logged messages that arrived since
+CONTROL_FEATURES = 7  # {"compression": the compressions of the frames the sender can read}
+MESSAGE_HEADER = struct.Struct('!QQIB')  # sender id, epoch milliseconds, sequence, name length
+TRANSFER_HEADER = struct.Struct('!QIIB')  # sender id, transfer number, chunk index, part
+# {"name": the sender name, "file": the file name, "size": bytes, "chunk_bytes": bytes per chunk}
+TRANSFER_BEGIN = 1
+TRANSFER_CHUNK = 2  # the bytes at chunk index * chunk_bytes
+TRANSFER_END = 3  # {"sha256": the hex digest of the file}
+TRANSFER_CHUNK_BYTES = 16384
+TRANSFER_WINDOW_BYTES = 1024 * 1024  # the most bulk data a transfer queues for a neighbor
+TRANSFER_POLL_SECONDS = 0.005  # how often a transfer waiting for its window checks again
+TRANSFER_IDLE_SECONDS = 60  # a download that gets no part for this long is given up
+COMPRESSED_LENGTH = struct.Struct('!I')  # the length of the text before compression
+COMPRESSION_ZLIB = 'zlib-dict-1'  # raw deflate (with a 4 KiB window) and COMPRESSION_DICTIONARY
+COMPRESSION_WINDOW_BITS = 12
+COMPRESSION_MEMORY_LEVEL = 4  # smaller states are much faster to set up for short texts
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_BYTES = 64  # shorter texts are sent as they are
+# strings common in chat and log lines, the most common last (nearest to the text);
+# changing it needs a new COMPRESSION_ZLIB name, as both ends must have the same one
+COMPRESSION_DICTIONARY = (
+    b'Traceback (most recent call last):  File "", line , in Exception: '
+    b'connection refused timed out reset by peer not found permission denied '
+    b'http:// https:// www. .com .org .html .json .py GET POST PUT DELETE HTTP/1.1 '
+    b'status=200 404 500 user= id= request response duration ms seconds bytes '
+    b'started stopped failed error warning debug info TRACE DEBUG INFO WARNING WARN ERROR '
+    b'because would could should about there their which other after before '
+    b'what when where your from have this that with will just like they them '
+    b'The the and for are but not you all can was were has had how its our out '
+    b'2026-01-01T00:00:00.000Z 2026-01-01 00:00:00,000 ')
+REFILL_BYTES = 64 * 1024  # the scheduler moves frames to a write buffer holding less than this
+DRR_QUANTUM_BYTES = 4096  # what each backlogged flow may send per round of the scheduler
+CONTROL_FLOW = 'control'  # the scheduler's priority lane
+BULK_FLOW = 'bulk'  # file transfers and log replays
+TEXT_FLOW = 'text'  # plain text (messages have a flow per sender id)
+FILE_COMMAND = '/file '  # an input line that starts with it sends the named file
+LOG_SEGMENT_BYTES = 16 * 1024 * 1024
+LOG_MAX_BYTES = 256 * 1024 * 1024  # older segments are deleted beyond this
+LOG_MAX_AGE_SECONDS = 7 * 24 * 3600  # segments whose messages are all older are deleted
+LOG_REPLAY_SLICE_BYTES = 64 * 1024  # about the most bytes of a segment queued at once in a replay
+CATCH_UP_SLACK_MILLISECONDS = 1000  # how much earlier than the last message a rejoining node asks
+INGEST_READ_BYTES = 1024 * 1024  # the size of the reads from the input of the ingest mode
+INGEST_BATCHES = 4  # the most batches of lines read ahead of the event loop
+INGEST_POLL_SECONDS = 0.01  # how often held batches and the final drain check the neighbors
+INGEST_REPORT_SECONDS = 10
+HUB_RING_BYTES = 16 * 1024 * 1024  # the shared-memory ring each worker of a hub writes to
+HUB_BACKLOG_PACKETS = 65536  # the most packets waiting for space in a full ring
+HUB_RETRY_SECONDS = 0.001  # how often a worker with a full ring tries again
+RING_CURSOR = struct.Struct('=Q')  # the bytes written to (or read from) a ring so far
+RING_RECORD = struct.Struct('=I')  # the length of the frame that follows
+RING_WRAP = 0xFFFFFFFF  # a record length meaning the rest of the ring is skipped
+MAX_FRAME_BYTES = 1024 * 1024
+HANDSHAKE_PREFIX = b'(system) p2p-tree hello'
+HANDSHAKE_HELLO = HANDSHAKE_PREFIX + b' v2'
+HANDSHAKE_ACK = HANDSHAKE_PREFIX + b'-ack v2'
+HANDSHAKE_TIMEOUT_SECONDS = 1  # the inviter's wait; the invitee waits twice as long
+OUTPUT_QUEUE_PACKETS = 65536  # the most messages waiting to be displayed
+GUI_OUTPUT_INTERVAL_MILLISECONDS = 50
+# relay phases: waiting in select, receiving, parsing frames, queueing to neighbors,
+# sending, and handing messages to the output
+METRIC_PHASES = ('select_wait', 'recv', 'parse', 'fanout', 'send', 'output')
+HISTOGRAM_BUCKETS_SECONDS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005,
+                             0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+METRICS_REQUEST_TIMEOUT_SECONDS = 5
+SEEN_MESSAGES = 65536  # the most message ids remembered for dropping duplicates
+SEEN_MESSAGES_SECONDS = 60  # how long a message id is remembered
+ANCESTORS_KEPT = 8  # the most ancestor addresses a node keeps for repairing the tree
+REPAIR_STAGGER_SECONDS = 0.25  # the head start of each preferred address when reconnecting
+REPAIR_CONNECTION_TIMEOUT_SECONDS = 2
+JOIN_MAX_REDIRECTS = 16  # a node redirected this often is accepted wherever it joins
+JOIN_HOLD_SECONDS = 2  # the longest a node that does not know its depth yet holds the JOINs it gets
 
 def make_header(name: typing.Union[None, str] = None) -> str:
     '''
@@ -35,176 +143,2715 @@ def make_packet(data: bytes) -> bytes:
     '''
     Packets are truncated/padded to a fixed-size.
     '''
-    global PACKET_LENGTH_BYTES
     if len(data) > PACKET_LENGTH_BYTES:
         return data[:PACKET_LENGTH_BYTES]
     else:
         return data + (b' ' * (PACKET_LENGTH_BYTES - len(data)))
 
+def make_handshake(greeting: bytes, port: int) -> bytes:
+    '''
+    Handshake units look like legacy packets, so legacy peers just display them.
+    They name the initiator's port of the connection,
+    so a unit relayed by a legacy peer is never mistaken for one sent over this connection.
+    '''
+    return make_packet(greeting + f' {port}'.encode())
+
+def make_frame(kind: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload), kind) + payload
+
+def make_control(control_type: int, body: dict) -> 'Packet':
+    return Packet(make_frame(FRAME_CONTROL, CONTROL_HEADER.pack(control_type) +
+                             json.dumps(body).encode()))
+
+class ProtocolError(Exception):
+    pass
+
+class Packet:
+    '''
+    A message on its way through the relay.
+    Relaying treats it as opaque bytes: one packet object is shared by all write buffers
+    it is queued in, and each wire encoding is built at most once.
+    "frame" is the v2 frame and the legacy packet is only made when a legacy neighbor needs it.
+    A compressed message keeps its compressed frame; the decompressed one ("plain")
+    is only made at an output sink or for a neighbor that cannot read compressed frames.
+    '''
+    __slots__ = ('frame', 'legacy_packet', 'plain_frame')
+
+    def __init__(self, frame: bytes, legacy_packet: typing.Union[None, bytes] = None):
+        self.frame = frame
+        self.legacy_packet = legacy_packet
+        self.plain_frame = None
+
+    def kind(self) -> int:
+        return self.frame[FRAME_HEADER.size - 1]
+
+    def flow(self) -> typing.Union[str, bytes]:
+        '''
+        The scheduler flow of the packet: the sender id of a message or a flow name.
+        '''
+        kind = self.kind()
+        if kind == FRAME_MESSAGE or kind == FRAME_COMPRESSED:
+            return self.frame[FRAME_HEADER.size:FRAME_HEADER.size + 8]
+        if kind == FRAME_CONTROL:
+            return CONTROL_FLOW
+        if kind == FRAME_TRANSFER:
+            return BULK_FLOW
+        return TEXT_FLOW
+
+    def payload(self) -> memoryview:
+        return memoryview(self.frame)[FRAME_HEADER.size:]
+
+    def message_id(self) -> typing.Union[None, bytes]:
+        '''
+        The sender id and the sequence number of a message,
+        or the whole TRANSFER_HEADER of a transfer frame (None for plain text).
+        '''
+        kind = self.kind()
+        frame = self.frame
+        if kind == FRAME_TRANSFER:
+            return frame[FRAME_HEADER.size:FRAME_HEADER.size + TRANSFER_HEADER.size]
+        if kind != FRAME_MESSAGE and kind != FRAME_COMPRESSED:
+            return None
+        return frame[FRAME_HEADER.size:FRAME_HEADER.size + 8] + frame[
+            FRAME_HEADER.size + 16:FRAME_HEADER.size + 20]
+
+    def plain(self) -> bytes:
+        '''
+        The frame with its text decompressed (other frames are returned as they are).
+        '''
+        if self.plain_frame is None:
+            if self.kind() != FRAME_COMPRESSED:
+                return self.frame
+            self.plain_frame = decompress_message(self.frame)
+        return self.plain_frame
+
+    def plain_length(self) -> int:
+        '''
+        The length of the decompressed frame, read from a compressed frame without decompressing it.
+        '''
+        frame = self.frame
+        if self.kind() != FRAME_COMPRESSED:
+            return len(frame)
+        offset = FRAME_HEADER.size + MESSAGE_HEADER.size + frame[FRAME_HEADER.size +
+                                                                 MESSAGE_HEADER.size - 1]
+        return offset + COMPRESSED_LENGTH.unpack_from(frame, offset)[0]
+
+    def encode(self, protocol: int) -> bytes:
+        '''
+        The frame for a v2 neighbor that cannot read compressed frames, or the legacy packet.
+        '''
+        if protocol == PROTOCOL_FRAMED:
+            return self.plain()
+        if self.legacy_packet is None:
+            self.legacy_packet = make_packet(LEGACY_RENDERER.render(self).rstrip('\n').encode())
+        return self.legacy_packet
+
+def decompress_message(frame: bytes) -> bytes:
+    '''
+    Turns a compressed message back into the FRAME_MESSAGE its origin compressed.
+    At most one byte more than the length the frame claims is decompressed
+    (origins never compress texts shorter than COMPRESSION_MIN_BYTES or longer than a frame),
+    and a text that is not exactly the whole compressed data of that length
+    is replaced by a note (the frame came from a broken or hostile node).
+    '''
+    payload = memoryview(frame)[FRAME_HEADER.size:]
+    text_offset = MESSAGE_HEADER.size + payload[MESSAGE_HEADER.size - 1]
+    text_length, = COMPRESSED_LENGTH.unpack_from(payload, text_offset)
+    text = None
+    if COMPRESSION_MIN_BYTES <= text_length <= MAX_FRAME_BYTES - text_offset:
+        decompressor = zlib.decompressobj(-COMPRESSION_WINDOW_BITS, zdict = COMPRESSION_DICTIONARY)
+        try:
+            text = decompressor.decompress(payload[text_offset + COMPRESSED_LENGTH.size:],
+                                           text_length + 1)  # 0 would mean no limit
+        except zlib.error:
+            pass
+        if not (decompressor.eof and not decompressor.unconsumed_tail and
+                not decompressor.unused_data):
+            text = None
+    if text is None or len(text) != text_length:
+        text = b'(a compressed message that cannot be decompressed)'
+    return make_frame(FRAME_MESSAGE, payload[:text_offset].tobytes() + text)
+
+class Renderer:
+    '''
+    Turns packets into display lines at an output sink.
+    Sender names are decoded once per sender and time strings are formatted once per second.
+    '''
+    __slots__ = ('names', 'second', 'time_string')
+
+    def __init__(self):
+        self.names = {}  # sender id -> name
+        self.second = None
+        self.time_string = ''
+
+    def render(self, packet: Packet) -> str:
+        kind = packet.kind()
+        if kind == FRAME_COMPRESSED:
+            payload = memoryview(packet.plain())[FRAME_HEADER.size:]
+        else:
+            payload = packet.payload()
+        if kind != FRAME_MESSAGE and kind != FRAME_COMPRESSED:
+            return str(payload, 'utf-8', 'replace') + '\n'
+        sender_id, milliseconds, _, name_length = MESSAGE_HEADER.unpack_from(payload)
+        text_offset = MESSAGE_HEADER.size + name_length
+        name = self.names.get(sender_id)
+        if name is None:
+            name = str(payload[MESSAGE_HEADER.size:text_offset], 'utf-8', 'replace')
+            self.names[sender_id] = name
+        second = milliseconds // 1000
+        if second != self.second:
+            self.second = second
+            self.time_string = datetime.datetime.fromtimestamp(
+                second, datetime.UTC).strftime('%Y-%m-%d %H:%M:%S')
+        text = str(payload[text_offset:], 'utf-8', 'replace')
+        return f'([{name}] {self.time_string}) {text}\n'
+
+LEGACY_RENDERER = Renderer()  # renders messages for legacy neighbors
+
+class Origin:
+    '''
+    The identity stamped on the messages of this node:
+    a random sender id, the name, and a sequence number.
+    Messages made with "compress" have their text compressed here, once,
+    and the totals (texts in and out, and the time taken) are kept for the metrics.
+    '''
+    __slots__ = ('sender_id', 'encoded_name', 'sequence',
+                 'compress_in_bytes', 'compress_out_bytes', 'compress_seconds')
+
+    def __init__(self, name: str):
+        self.sender_id = random.getrandbits(64)
+        self.encoded_name = name.encode()[:255]
+        self.sequence = 0
+        self.compress_in_bytes = 0
+        self.compress_out_bytes = 0
+        self.compress_seconds = 0.0
+
+    def make_message(self, text: typing.Union[str, bytes], compress: bool = False) -> Packet:
+        '''
+        A message of this node. A compressed text that is not shorter is sent as it is.
+        '''
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        header = MESSAGE_HEADER.pack(self.sender_id, time.time_ns() // 1000000, self.sequence,
+                                     len(self.encoded_name))
+        if isinstance(text, str):
+            text = text.encode()
+        if compress and len(text) >= COMPRESSION_MIN_BYTES:
+            start = time.perf_counter()
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -COMPRESSION_WINDOW_BITS,
+                                          COMPRESSION_MEMORY_LEVEL, zdict = COMPRESSION_DICTIONARY)
+            data = compressor.compress(text) + compressor.flush()
+            self.compress_seconds += time.perf_counter() - start
+            self.compress_in_bytes += len(text)
+            if COMPRESSED_LENGTH.size + len(data) < len(text):
+                self.compress_out_bytes += COMPRESSED_LENGTH.size + len(data)
+                return Packet(make_frame(FRAME_COMPRESSED, header + self.encoded_name +
+                                         COMPRESSED_LENGTH.pack(len(text)) + data))
+            self.compress_out_bytes += len(text)
+        return Packet(make_frame(FRAME_MESSAGE, header + self.encoded_name + text))
+
+    def max_text_bytes(self) -> int:
+        return MAX_FRAME_BYTES - MESSAGE_HEADER.size - len(self.encoded_name)
+
+    def split_text(self, text: typing.Union[str, bytes]) -> list[bytes]:
+        '''
+        The pieces of a text that each fit in a message of this node
+        (receivers drop the link of a frame over MAX_FRAME_BYTES).
+        '''
+        if isinstance(text, str):
+            text = text.encode()
+        max_bytes = self.max_text_bytes()
+        return [text[i:i + max_bytes] for i in range(0, max(len(text), 1), max_bytes)]
+
+class SeenMessages:
+    '''
+    The ids of recently relayed messages, for dropping the duplicates that arrive over
+    redundant links. Ids older than "window_seconds" and the least recently seen ids
+    beyond "capacity" are forgotten, so the memory stays bounded under any traffic.
+    '''
+    def __init__(self, capacity: int = SEEN_MESSAGES, window_seconds: float = SEEN_MESSAGES_SECONDS):
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.ids = collections.OrderedDict()  # message id -> when it was last seen
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, message_id: bytes, now: float) -> bool:
+        '''
+        Remembers a message id; returns False if it had been seen already.
+        '''
+        ids = self.ids
+        if message_id in ids:
+            ids.move_to_end(message_id)
+            ids[message_id] = now
+            return False
+        ids[message_id] = now
+        if len(ids) > self.capacity:
+            ids.popitem(last = False)
+        oldest = now - self.window_seconds
+        while ids:
+            first = next(iter(ids))
+            if ids[first] >= oldest:
+                break
+            del ids[first]
+        return True
+
+def unused_path(directory: str, file_name: str) -> str:
+    '''
+    A path in "directory" for a received file, keeping only the last component of its name
+    and numbering it if a file (or a partial download) of that name exists.
+    '''
+    file_name = os.path.basename(file_name.replace('\\', '/')).strip()
+    if file_name in ('', '.', '..'):
+        file_name = 'file'
+    stem, extension = os.path.splitext(file_name)
+    path = os.path.join(directory, file_name)
+    for number in itertools.count(1):
+        if not os.path.exists(path) and not os.path.exists(path + '.part'):
+            return path
+        path = os.path.join(directory, f'{stem} ({number}){extension}')
+
+class Download:
+    '''
+    A file being received. It is written to "<path>.part", which is preallocated
+    and memory-mapped, so each chunk is copied into place as it arrives
+    and the memory used does not depend on the size of the file.
+    The frames of a transfer arrive in order (links keep the order of the bulk flows),
+    so the checksum is computed as the chunks arrive and a missing chunk fails the transfer.
+    The file gets its name only once it is complete and its checksum matches.
+    "source" is the link the last part came over and "active" when (in monotonic seconds),
+    so the node can give up a download whose sender is gone.
+    '''
+    def __init__(self, path: str, size: int, chunk_bytes: int, source: typing.Any = None):
+        self.path = path
+        self.size = size
+        self.chunk_bytes = chunk_bytes
+        self.source = source
+        self.active = time.monotonic()
+        self.next_index = 0
+        self.written = 0
+        self.digest = hashlib.sha256()
+        self.file = open(path + '.part', 'x+b')
+        self.mapping = None
+        try:
+            if size:
+                try:
+                    os.posix_fallocate(self.file.fileno(), 0, size)
+                except (AttributeError, OSError):  # e.g. not supported by the file system
+                    self.file.truncate(size)
+                self.mapping = mmap.mmap(self.file.fileno(), size)
+        except (OSError, ValueError):
+            self.abort()
+            raise
+
+    def write(self, index: int, data: memoryview) -> bool:
+        '''
+        Stores a chunk; returns False if it is not the next one or does not fit.
+        '''
+        offset = index * self.chunk_bytes
+        if index != self.next_index or offset != self.written or offset + len(data) > self.size:
+            return False
+        self.mapping[offset:offset + len(data)] = data
+        self.digest.update(data)
+        self.next_index += 1
+        self.written += len(data)
+        return True
+
+    def finish(self, sha256: str) -> bool:
+        '''
+        Names the file if it is complete and intact (otherwise deletes it).
+        '''
+        intact = self.written == self.size and self.digest.hexdigest() == sha256
+        self.close()
+        if not intact:
+            os.unlink(self.path + '.part')
+            return False
+        os.replace(self.path + '.part', self.path)
+        return True
+
+    def abort(self) -> None:
+        self.close()
+        try:
+            os.unlink(self.path + '.part')
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        self.file.close()
+
+class LogSegment:
+    '''
+    A file of the message log: v2 message frames back to back in a preallocated,
+    memory-mapped file, followed by zeros (a frame header of zeros ends the frames).
+    "offsets" and "times" index the frames by their sequence in the log
+    (from "first_sequence") and by the time they arrived (in epoch milliseconds).
+    A segment the log no longer keeps ("retire") is only unmapped and deleted
+    once the replays that hold it ("hold" and "release") are done with it.
+    '''
+    __slots__ = ('path', 'first_sequence', 'file', 'mapping', 'offsets', 'times', 'end',
+                 'readers', 'retired')
+
+    def __init__(self, path: str, first_sequence: int, size: typing.Union[None, int] = None):
+        '''
+        Creates a segment of "size" bytes, or opens an existing one (and indexes it).
+        '''
+        self.path = path
+        self.first_sequence = first_sequence
+        self.offsets = []
+        self.times = []
+        self.end = 0
+        self.readers = 0
+        self.retired = False
+        self.file = open(path, 'r+b' if size is None else 'x+b')
+        try:
+            if size is not None:
+                try:
+                    os.posix_fallocate(self.file.fileno(), 0, size)
+                except (AttributeError, OSError):  # e.g. not supported by the file system
+                    self.file.truncate(size)
+            self.mapping = mmap.mmap(self.file.fileno(), 0)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def scan(self, floor: int) -> None:
+        '''
+        Indexes the frames of an existing segment. Their arrival times are not stored,
+        so the times in the messages are used (never going below "floor" or back in time).
+        A frame cut short (by a crash) and anything after it are overwritten by later appends.
+        '''
+        mapping = self.mapping
+        offset = 0
+        while offset + FRAME_HEADER.size <= len(mapping):
+            length, kind = FRAME_HEADER.unpack_from(mapping, offset)
+            end = offset + FRAME_HEADER.size + length
+            if kind != FRAME_MESSAGE or length < MESSAGE_HEADER.size or end > len(mapping):
+                break
+            _, milliseconds, _, _ = MESSAGE_HEADER.unpack_from(mapping, offset + FRAME_HEADER.size)
+            floor = max(floor, milliseconds)
+            self.offsets.append(offset)
+            self.times.append(floor)
+            offset = end
+        self.end = offset
+        terminator = min(len(mapping), offset + FRAME_HEADER.size)
+        mapping[offset:terminator] = bytes(terminator - offset)
+
+    def fits(self, size: int) -> bool:
+        return self.end + size <= len(self.mapping)
+
+    def append(self, frame: bytes, milliseconds: int) -> None:
+        self.mapping[self.end:self.end + len(frame)] = frame
+        self.offsets.append(self.end)
+        self.times.append(milliseconds)
+        self.end += len(frame)
+
+    def offset(self, index: int) -> int:
+        return self.offsets[index] if index < len(self.offsets) else self.end
+
+    def hold(self) -> None:
+        self.readers += 1
+
+    def release(self) -> None:
+        self.readers -= 1
+        if self.retired and not self.readers:
+            self.delete()
+
+    def retire(self) -> None:
+        self.retired = True
+        if not self.readers:
+            self.delete()
+
+    def delete(self) -> None:
+        self.close()
+        os.unlink(self.path)
+
+    def close(self) -> None:
+        try:
+            self.mapping.close()
+        except BufferError:  # views of it are still queued to be sent; it is unmapped with them
+            pass
+        self.file.close()
+
+class LogReplay:
+    '''
+    Views of the frames of the message log with sequences from "start" to "end" (exclusive),
+    in slices of whole frames of about "slice_bytes".
+    It holds the segments it has yet to send, so the log deletes none of them under it,
+    and releases each one when done with it (and the rest when closed).
+    '''
+    __slots__ = ('segments', 'sequence', 'end', 'slice_bytes')
+
+    def __init__(self, segments: list[LogSegment], start: int, end: int, slice_bytes: int):
+        self.segments = collections.deque(segments)
+        self.sequence = start
+        self.end = end
+        self.slice_bytes = slice_bytes
+        for segment in segments:
+            segment.hold()
+
+    def __iter__(self) -> 'LogReplay':
+        return self
+
+    def __next__(self) -> memoryview:
+        segments = self.segments
+        while segments:
+            segment = segments[0]
+            i = max(self.sequence - segment.first_sequence, 0)
+            j = min(self.end - segment.first_sequence, len(segment))
+            if i < j:
+                begin = segment.offsets[i]
+                k = bisect.bisect_right(segment.offsets, begin + self.slice_bytes, i + 1, j)
+                self.sequence = segment.first_sequence + k
+                return memoryview(segment.mapping)[begin:segment.offset(k)]
+            segments.popleft().release()
+        raise StopIteration
+
+    def close(self) -> None:
+        while self.segments:
+            self.segments.popleft().release()
+
+    def __del__(self):
+        self.close()
+
+class MessageLog:
+    '''
+    An append-only log of the messages a node relayed, in segment files of "directory"
+    named by the sequence of their first message. Frames are copied into memory-mapped segments
+    as they are, so a replay ("slices") sends views of the segments without copying or encoding.
+    The oldest segments are deleted while the log takes more than "max_bytes"
+    or all their messages are older than "max_age_seconds" (the last segment is always kept),
+    though their files stay until the replays still sending them are done.
+    '''
+    def __init__(self, directory: str, segment_bytes: int = LOG_SEGMENT_BYTES,
+                 max_bytes: int = LOG_MAX_BYTES, max_age_seconds: float = LOG_MAX_AGE_SECONDS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.segments = []
+        floor = 0
+        for file_name in sorted(os.listdir(directory)):
+            stem, extension = os.path.splitext(file_name)
+            if extension != '.log' or not stem.isdigit():
+                continue
+            first_sequence = int(stem)
+            if self.segments and first_sequence < self.next_sequence():
+                continue  # overlaps the previous segment (not written by this class)
+            segment = LogSegment(os.path.join(directory, file_name), first_sequence)
+            segment.scan(floor)
+            floor = segment.times[-1] if segment.times else floor
+            self.segments.append(segment)
+        self.retain(time.time_ns() // 1000000)
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+    def first_sequence(self) -> int:
+        return self.segments[0].first_sequence if self.segments else 0
+
+    def next_sequence(self) -> int:
+        '''
+        The sequence the next message will get.
+        '''
+        if not self.segments:
+            return 0
+        return self.segments[-1].first_sequence + len(self.segments[-1])
+
+    def size(self) -> int:
+        return sum(len(segment.mapping) for segment in self.segments)
+
+    def append(self, frame: bytes, milliseconds: int) -> None:
+        '''
+        Logs a message frame that arrived at "milliseconds" (never before the last one).
+        '''
+        segment = self.segments[-1] if self.segments else None
+        if segment is not None and segment.times:
+            milliseconds = max(milliseconds, segment.times[-1])
+        if segment is None or not segment.fits(len(frame) + FRAME_HEADER.size):
+            sequence = self.next_sequence()
+            segment = LogSegment(os.path.join(self.directory, f'{sequence:020d}.log'), sequence,
+                                 max(self.segment_bytes, len(frame) + FRAME_HEADER.size))
+            self.segments.append(segment)
+            self.retain(milliseconds)
+        segment.append(frame, milliseconds)
+
+    def retain(self, milliseconds: int) -> None:
+        oldest = milliseconds - self.max_age_seconds * 1000
+        while len(self.segments) > 1 and (self.size() > self.max_bytes or
+                                          not self.segments[0].times or
+                                          self.segments[0].times[-1] < oldest):
+            self.segments.pop(0).retire()
+
+    def sequence_at(self, milliseconds: int) -> int:
+        '''
+        The sequence of the first message that arrived at or after "milliseconds".
+        '''
+        for segment in self.segments:
+            if segment.times and segment.times[-1] >= milliseconds:
+                return segment.first_sequence + bisect.bisect_left(segment.times, milliseconds)
+        return self.next_sequence()
+
+    def slices(self, start: int, end: int,
+               slice_bytes: int = LOG_REPLAY_SLICE_BYTES) -> LogReplay:
+        '''
+        Views of the frames with sequences from "start" to "end" (exclusive) (see LogReplay).
+        '''
+        return LogReplay([segment for segment in self.segments
+                          if segment.first_sequence < end and
+                          segment.first_sequence + len(segment) > start], start, end, slice_bytes)
+
+    def replay(self, since: int) -> tuple[int, LogReplay]:
+        '''
+        The number of messages that arrived since "since" (epoch milliseconds)
+        and are younger than "max_age_seconds", and the views to send them.
+        '''
+        now = time.time_ns() // 1000000
+        self.retain(now)
+        start = self.sequence_at(max(since, now - int(self.max_age_seconds * 1000)))
+        end = self.next_sequence()
+        return end - start, self.slices(start, end)
+
+    def close(self) -> None:
+        for segment in self.segments:
+            segment.mapping.flush()
+            segment.close()
+        self.segments = []
+
+class ReadBuffer:
+    '''
+    A growable bytearray that sockets receive into directly through "recv_into".
+    Unread bytes live in data[start:end]; consuming only moves "start",
+    and the (usually tiny) unread tail is moved to the front only when the free space runs out.
+    '''
+    __slots__ = ('data', 'start', 'end')
+
+    def __init__(self, capacity: int = READ_BUFFER_INITIAL_BYTES):
+        self.data = bytearray(capacity)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def free_space(self) -> memoryview:
+        '''
+        A writable view of the free space at the end; call "commit" with the number of bytes filled.
+        The caller must release the view before the next call, since a bytearray cannot be resized
+        while views of it exist.
+        '''
+        if self.end == len(self.data):
+            unread = self.end - self.start
+            if self.start:
+                self.data[:unread] = self.data[self.start:self.end]
+                self.start = 0
+                self.end = unread
+            if unread * 2 > len(self.data):  # still mostly full after moving the tail
+                self.data.extend(bytes(len(self.data)))
+        return memoryview(self.data)[self.end:]
+
+    def commit(self, size: int) -> None:
+        self.end += size
+
+    def view(self) -> memoryview:
+        '''
+        A read-only view of the unread bytes (released by the caller like "free_space").
+        '''
+        return memoryview(self.data)[self.start:self.end].toreadonly()
+
+    def consume(self, size: int) -> None:
+        self.start += size
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+
+class WriteBuffer:
+    '''
+    A queue of immutable chunks waiting to be sent.
+    Chunks are never concatenated or copied:
+    appending stores a reference (so one packet relayed to many neighbors exists only once),
+    many chunks go out in one scatter-gather "sendmsg" call,
+    and a partial send only moves the offset into the first chunk.
+    Chunks appended as not droppable (handshakes and control frames) are never dropped.
+    '''
+    __slots__ = ('chunks', 'offset', 'size', 'kept')
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.offset = 0
+        self.size = 0  # the number of unsent bytes
+        self.kept = set()  # the ids of the chunks that are not droppable
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, chunk: bytes, droppable: bool = True) -> None:
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if not droppable:
+            self.kept.add(id(chunk))
+
+    def first(self) -> memoryview:
+        return memoryview(self.chunks[0])[self.offset:]
+
+    def send_to(self, the_socket: socket.socket) -> tuple[int, bool]:
+        '''
+        Sends a batch of queued chunks with one system call and consumes the sent bytes.
+        Returns the number of bytes sent and whether the whole batch was accepted.
+        '''
+        with self.first() as first:
+            if hasattr(the_socket, 'sendmsg'):
+                buffers = [first]
+                buffers.extend(itertools.islice(self.chunks, 1, SEND_BATCH_CHUNKS))
+                batch_size = sum(len(buffer) for buffer in buffers)
+                sent = the_socket.sendmsg(buffers)
+            else:  # e.g. Windows
+                batch_size = len(first)
+                sent = the_socket.send(first)
+        self.consume(sent)
+        return sent, sent == batch_size
+
+    def consume(self, size: int) -> None:
+        self.size -= size
+        while size:
+            remaining = len(self.chunks[0]) - self.offset
+            if size < remaining:
+                self.offset += size
+                return
+            chunk = self.chunks.popleft()
+            if self.kept:
+                self.kept.discard(id(chunk))
+            self.offset = 0
+            size -= remaining
+
+    def drop_oldest(self) -> bool:
+        '''
+        Drops the oldest droppable chunk that has not been partially sent (a partially sent chunk
+        must be finished to keep the stream aligned). Returns whether a chunk was dropped.
+        '''
+        for index in range(1 if self.offset else 0, len(self.chunks)):
+            chunk = self.chunks[index]
+            if id(chunk) not in self.kept:
+                self.size -= len(chunk)
+                del self.chunks[index]
+                return True
+        return False
+
+class QueueLimits:
+    '''
+    Watermarks for a neighbor's write buffer (in bytes and in packets)
+    and the policy applied once a high watermark is crossed:
+    "backpressure" stops reading from the neighbors that feed it until the buffer drains
+    below both low watermarks, "drop-oldest"/"drop-newest" drop packets,
+    and "disconnect" drops the slow neighbor.
+    '''
+    __slots__ = ('high_bytes', 'low_bytes', 'high_packets', 'low_packets', 'policy')
+
+    def __init__(self, high_bytes: int = 4 * 1024 * 1024, low_bytes: int = 2 * 1024 * 1024,
+                 high_packets: int = 32768, low_packets: int = 16384,
+                 policy: str = 'backpressure'):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'unknown queue policy "{policy}"')
+        self.high_bytes = high_bytes
+        self.low_bytes = low_bytes
+        self.high_packets = high_packets
+        self.low_packets = low_packets
+        self.policy = policy
+
+class RateLimit:
+    '''
+    A token bucket for the bytes received from each neighbor:
+    "rate_bytes" per second, in bursts of up to "burst_bytes".
+    A neighbor that runs out of tokens is not read from until its bucket refills,
+    so TCP slows down the part of the tree behind it and nothing else.
+    '''
+    __slots__ = ('rate_bytes', 'burst_bytes')
+
+    def __init__(self, rate_bytes: float, burst_bytes: typing.Union[None, float] = None):
+        if rate_bytes <= 0 or (burst_bytes is not None and burst_bytes <= 0):
+            raise ValueError('the rate limit needs a positive rate and burst')
+        self.rate_bytes = rate_bytes
+        self.burst_bytes = rate_bytes if burst_bytes is None else burst_bytes
+
+class Flow:
+    '''
+    The frames of one flow (a sender, plain text, or bulk data) waiting in a neighbor's scheduler,
+    and the bytes the flow may still send in the current round (its deficit).
+    '''
+    __slots__ = ('key', 'chunks', 'deficit')
+
+    def __init__(self, key: typing.Union[str, bytes]):
+        self.key = key
+        self.chunks = collections.deque()
+        self.deficit = DRR_QUANTUM_BYTES
+
+class JoinPolicy:
+    '''
+    Where nodes joining the tree attach. A node at "max_depth" (counting the height
+    of the joining subtree) redirects joining nodes to its farthest known ancestor,
+    and a node with "max_children" children redirects them to the child with the smallest
+    subtree, so the tree stays shallow and the fan-out is spread.
+    '''
+    __slots__ = ('max_children', 'max_depth')
+
+    def __init__(self, max_children: int = 8, max_depth: int = 16):
+        if max_children < 1 or max_depth < 1:
+            raise ValueError('the join policy needs at least 1 child and a depth of 1')
+        self.max_children = max_children
+        self.max_depth = max_depth
+
 class Neighbor:
     '''
     Each neighbor object contains:
     (1) a read buffer containing data received from the corresponding neighbor node,
-    (2) a write buffer containing data to be sent to the corresponding neighbor node.
+    (2) a write buffer containing data to be sent to the corresponding neighbor node,
+    (3) the selector events the event loop currently watches on its socket (0 if unregistered),
+    (4) the limits of the write buffer and the resulting state and counters,
+    (5) the negotiated protocol (None during the handshake),
+    (6) whether it is an extra link (opened with "links") rather than a link of the tree,
+    (7) its listening address (known once it joined), whether it is a child in the tree,
+    and the size and height of the child's subtree,
+    (8) a scheduler that moves frames to the write buffer only while it holds less than
+    REFILL_BYTES: control frames first, then the backlogged flows (a flow per sender,
+    one for plain text and one for file transfers and the replay of the message log)
+    by deficit round-robin, so a flooding sender only delays the others by a quantum per round,
+    (9) its token bucket (with a rate limit) and whether it is not read from until it refills,
+    (10) whether it reads compressed frames (learned from its FEATURES), the bytes of the
+    compressed frames sent to it as they are and their decompressed length,
+    and the time spent decompressing frames for it (when it cannot read them, or is legacy).
     All buffers append new data to the right end.
+    The neighbor that opened the connection (the initiator) sends a hello first;
+    a v2 inviter answers with an ack and both sides switch to frames.
+    Any other first packet, or no answer before the deadline, means a legacy peer.
     '''
+    __slots__ = ('the_socket', 'remote_address', 'read_buffer', 'write_buffer', 'events',
+                 'limits', 'congested', 'overflowed', 'dropped_packets',
+                 'initiator', 'protocol', 'handshake_deadline', 'expected_handshake',
+                 'pending_packets', 'extra', 'listen_address', 'child',
+                 'subtree_size', 'subtree_height', 'controls', 'flows', 'active_flows',
+                 'scheduled_bytes', 'scheduled_packets', 'replay',
+                 'tokens', 'tokens_updated', 'throttled', 'compression',
+                 'compressed_bytes', 'uncompressed_bytes', 'decompress_seconds')
+
     def __init__(self, the_socket: socket.socket, remote_address: tuple[str, int],
-                 read_buffer: bytes, write_buffer: bytes):
+                 limits: QueueLimits, initiator: bool = False,
+                 local_address: typing.Union[None, tuple[str, int]] = None, extra: bool = False):
         self.the_socket = the_socket
         self.remote_address = remote_address
-        self.read_buffer = read_buffer
-        self.write_buffer = write_buffer
+        self.read_buffer = ReadBuffer()
+        self.write_buffer = WriteBuffer()
+        self.events = 0
+        self.limits = limits
+        self.congested = False  # above the high watermarks under the "backpressure" policy
+        self.overflowed = False  # above the high watermarks under the "disconnect" policy
+        self.dropped_packets = 0
+        self.initiator = initiator
+        self.protocol = None
+        self.handshake_deadline = time.monotonic() + HANDSHAKE_TIMEOUT_SECONDS * (
+            2 if initiator else 1)
+        self.pending_packets = []  # packets to be encoded once the protocol is known
+        self.extra = extra
+        self.listen_address = remote_address if initiator else None
+        self.child = False
+        self.subtree_size = 1
+        self.subtree_height = 0
+        self.controls = collections.deque()  # control frames waiting for the write buffer
+        self.flows = {}  # key -> the Flow of a backlogged flow
+        self.active_flows = collections.deque()  # the backlogged flows in round-robin order
+        self.scheduled_bytes = 0  # in the control lane and the flows
+        self.scheduled_packets = 0
+        self.replay = None  # views of the message log to send in the bulk flow
+        self.tokens = None  # the token bucket (full until the first receive)
+        self.tokens_updated = None
+        self.throttled = False
+        self.compression = False
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+        self.decompress_seconds = 0.0
+        if initiator:
+            port = (the_socket.getsockname() if local_address is None else local_address)[1]
+            self.write_buffer.append(make_handshake(HANDSHAKE_HELLO, port), droppable = False)
+            self.expected_handshake = make_handshake(HANDSHAKE_ACK, port)
+        else:
+            self.expected_handshake = make_handshake(HANDSHAKE_HELLO, remote_address[1])
+
+    def negotiated(self, protocol: int) -> None:
+        self.protocol = protocol
+        for packet in self.pending_packets:
+            self.enqueue(packet)
+        self.pending_packets = None
+
+    def check_handshake(self, now: float) -> None:
+        if self.protocol is None and now >= self.handshake_deadline:
+            self.negotiated(PROTOCOL_LEGACY)
+
+    def mismatched_handshake(self, first_packet: bytes) -> None:
+        '''
+        Logs a first packet that is the expected handshake but for another port:
+        one relayed by a legacy node, or one whose port was changed on the way (by a NAT or a proxy),
+        which cannot be told apart, so both mean a legacy peer.
+        '''
+        greeting = (HANDSHAKE_ACK if self.initiator else HANDSHAKE_HELLO) + b' '
+        if not first_packet.startswith(greeting):
+            return
+        port = str(first_packet[len(greeting):].strip(), 'utf-8', 'replace')
+        expected = str(self.expected_handshake[len(greeting):].strip(), 'utf-8', 'replace')
+        dump_to_stderr(make_header() +
+                       f'the handshake of {self.remote_address} names port {port} instead of '
+                       f'{expected} (relayed by a legacy node, or changed by a NAT or a proxy); '
+                       f'speaking the legacy protocol to it\n')
+
+    def receive_packets(self) -> list[Packet]:
+        '''
+        Parses all whole packets out of the read buffer, negotiating the protocol first if needed.
+        '''
+        packets = []
+        read_buffer = self.read_buffer
+        with read_buffer.view() as unread:
+            offset = 0
+            if self.protocol is None and len(unread) >= PACKET_LENGTH_BYTES:
+                if unread[:PACKET_LENGTH_BYTES] != self.expected_handshake:
+                    self.mismatched_handshake(bytes(unread[:PACKET_LENGTH_BYTES]))
+                    self.negotiated(PROTOCOL_LEGACY)
+                else:
+                    offset += PACKET_LENGTH_BYTES
+                    if not self.initiator:  # the ack must precede all frames
+                        port = self.remote_address[1]
+                        self.write_buffer.append(make_handshake(HANDSHAKE_ACK, port),
+                                                 droppable = False)
+                    self.negotiated(PROTOCOL_FRAMED)
+            if self.protocol == PROTOCOL_LEGACY:
+                while len(unread) - offset >= PACKET_LENGTH_BYTES:
+                    legacy_packet = bytes(unread[offset:offset + PACKET_LENGTH_BYTES])
+                    offset += PACKET_LENGTH_BYTES
+                    if legacy_packet.startswith(HANDSHAKE_PREFIX):  # a late or relayed handshake
+                        continue
+                    packets.append(Packet(make_frame(FRAME_TEXT, legacy_packet.strip()),
+                                          legacy_packet))
+            elif self.protocol == PROTOCOL_FRAMED:
+                while len(unread) - offset >= FRAME_HEADER.size:
+                    length, kind = FRAME_HEADER.unpack_from(unread, offset)
+                    if length > MAX_FRAME_BYTES:
+                        raise ProtocolError(f'frame of {length} bytes')
+                    end = offset + FRAME_HEADER.size + length
+                    if len(unread) < end:
+                        break
+                    frame = bytes(unread[offset:end])
+                    offset = end
+                    if kind == FRAME_TEXT:
+                        packets.append(Packet(frame))
+                    elif kind == FRAME_MESSAGE:
+                        if length < MESSAGE_HEADER.size:
+                            raise ProtocolError(f'message of {length} bytes')
+                        packets.append(Packet(frame))
+                    elif kind == FRAME_CONTROL:
+                        if length < CONTROL_HEADER.size:
+                            raise ProtocolError(f'control frame of {length} bytes')
+                        packets.append(Packet(frame))
+                    elif kind == FRAME_TRANSFER:
+                        if length < TRANSFER_HEADER.size:
+                            raise ProtocolError(f'transfer frame of {length} bytes')
+                        packets.append(Packet(frame))
+                    elif kind == FRAME_COMPRESSED:
+                        if (length < MESSAGE_HEADER.size or length < MESSAGE_HEADER.size +
+                            frame[FRAME_HEADER.size + MESSAGE_HEADER.size - 1] + COMPRESSED_LENGTH.size):
+                            raise ProtocolError(f'compressed message of {length} bytes')
+                        packets.append(Packet(frame))
+                    # note: frames of unknown kinds are skipped for forward compatibility
+        read_buffer.consume(offset)
+        return packets
+
+    def queued_bytes(self) -> int:
+        return len(self.write_buffer) + self.scheduled_bytes
+
+    def queued_packets(self) -> int:
+        return len(self.write_buffer.chunks) + self.scheduled_packets
+
+    def above_high_watermark(self, extra_bytes: int = 0, extra_packets: int = 0) -> bool:
+        return ((self.queued_bytes() + extra_bytes > self.limits.high_bytes) or
+                (self.queued_packets() + extra_packets > self.limits.high_packets))
+
+    def below_low_watermark(self) -> bool:
+        return ((self.queued_bytes() <= self.limits.low_bytes) and
+                (self.queued_packets() <= self.limits.low_packets))
+
+    def enqueue(self, packet: Packet) -> None:
+        '''
+        Queues a packet to be sent to this neighbor and applies the queue policy.
+        Transfer frames are never sent to legacy neighbors.
+        Compressed messages are sent as they are if the neighbor reads them.
+        '''
+        if self.protocol is None:
+            self.pending_packets.append(packet)
+            return
+        key = packet.flow()
+        if key == BULK_FLOW and self.protocol == PROTOCOL_LEGACY:
+            return
+        if packet.kind() != FRAME_COMPRESSED:
+            data = packet.encode(self.protocol)
+        elif self.compression:
+            data = packet.frame
+            self.compressed_bytes += len(data)
+            self.uncompressed_bytes += packet.plain_length()
+        else:  # the first such neighbor pays for the decompression
+            start = time.perf_counter()
+            data = packet.encode(self.protocol)
+            self.decompress_seconds += time.perf_counter() - start
+        policy = self.limits.policy
+        if (policy == 'drop-newest' and key != CONTROL_FLOW and
+            self.above_high_watermark(len(data), 1)):
+            self.dropped_packets += 1
+            return
+        if (not self.scheduled_packets and self.replay is None and
+            len(self.write_buffer) < REFILL_BYTES):  # nothing to be fair to
+            self.write_buffer.append(data, key != CONTROL_FLOW)
+        else:
+            self.schedule(key, data)
+        if not self.above_high_watermark():
+            return
+        if policy == 'drop-oldest':
+            while self.above_high_watermark() and (self.drop_from_longest_flow() or
+                                                   self.write_buffer.drop_oldest()):
+                self.dropped_packets += 1
+        elif policy == 'backpressure':
+            self.congested = True
+        elif policy == 'disconnect':
+            self.overflowed = True
+
+    def schedule(self, key: typing.Union[str, bytes], data: bytes) -> None:
+        if key == CONTROL_FLOW:
+            self.controls.append(data)
+        else:
+            flow = self.flows.get(key)
+            if flow is None:
+                flow = self.flows[key] = Flow(key)
+                self.active_flows.append(flow)
+            flow.chunks.append(data)
+        self.scheduled_bytes += len(data)
+        self.scheduled_packets += 1
+        self.refill()
+
+    def refill(self) -> None:
+        '''
+        Moves scheduled frames to the write buffer while it holds less than REFILL_BYTES:
+        control frames first, then a round-robin over the backlogged flows,
+        where each flow sends frames while its deficit covers them
+        and gets DRR_QUANTUM_BYTES more each time its turn comes.
+        '''
+        write_buffer = self.write_buffer
+        controls = self.controls
+        active_flows = self.active_flows
+        if self.replay is not None and BULK_FLOW not in self.flows:
+            self.replay_more()
+        while len(write_buffer) < REFILL_BYTES:
+            if controls:
+                data = controls.popleft()
+                droppable = False
+            elif active_flows:
+                droppable = True
+                flow = active_flows[0]
+                data = flow.chunks[0]
+                if len(data) > flow.deficit:
+                    flow.deficit += DRR_QUANTUM_BYTES
+                    active_flows.rotate(-1)
+                    continue
+                flow.chunks.popleft()
+                flow.deficit -= len(data)
+                if not flow.chunks and not (flow.key == BULK_FLOW and self.replay_more()):
+                    active_flows.popleft()
+                    del self.flows[flow.key]
+            else:
+                return
+            self.scheduled_bytes -= len(data)
+            self.scheduled_packets -= 1
+            write_buffer.append(data, droppable)
+
+    def replay_more(self) -> bool:
+        '''
+        Schedules the next views of the message log in the bulk flow; returns whether there were any.
+        '''
+        data = next(self.replay, None)
+        if data is None:
+            self.replay = None
+            return False
+        flow = self.flows.get(BULK_FLOW)
+        if flow is None:
+            flow = self.flows[BULK_FLOW] = Flow(BULK_FLOW)
+            self.active_flows.append(flow)
+        flow.chunks.append(data)
+        self.scheduled_bytes += len(data)
+        self.scheduled_packets += 1
+        return True
+
+    def drop_from_longest_flow(self) -> bool:
+        '''
+        Drops the oldest frame of the flow with the most frames (never a control frame).
+        Returns whether a frame was dropped.
+        '''
+        if not self.flows:
+            return False
+        flow = max(self.flows.values(), key = lambda flow: len(flow.chunks))
+        data = flow.chunks.popleft()
+        self.scheduled_bytes -= len(data)
+        self.scheduled_packets -= 1
+        if not flow.chunks:
+            self.active_flows.remove(flow)
+            del self.flows[flow.key]
+        return True
+
+    def sent(self) -> None:
+        '''
+        Updates the backpressure state after some of the write buffer has been sent.
+        '''
+        if self.congested and self.below_low_watermark():
+            self.congested = False
 
     def __str__(self):
         return (f'Neighbor {id(self.the_socket)} {self.the_socket.getsockname()} '
-                f'{self.remote_address} {self.read_buffer} {self.write_buffer}')
+                f'{self.remote_address} {len(self.read_buffer)} {len(self.write_buffer)}')
+
+class OutputQueue:
+    '''
+    Hands packets from the event loop to a writer (a thread or a GUI timer)
+    without ever blocking the loop. The writer takes all queued packets at once,
+    so it renders and displays them in one batch.
+    If the writer falls too far behind, the oldest packets are dropped (and counted).
+    '''
+    def __init__(self, capacity: int = OUTPUT_QUEUE_PACKETS):
+        self.packets = collections.deque(maxlen = capacity)
+        self.ready = threading.Event()
+        self.closed = False
+        self.dropped_packets = 0
+
+    def put(self, packet: Packet) -> None:
+        if len(self.packets) == self.packets.maxlen:
+            self.dropped_packets += 1
+        self.packets.append(packet)
+        self.ready.set()
+
+    def take(self) -> list[Packet]:
+        self.ready.clear()
+        batch = []
+        while True:
+            try:
+                batch.append(self.packets.popleft())
+            except IndexError:
+                return batch
 
-def listener_core(lock: threading.Lock, server_socket: socket.socket,
-                  neighbors: list[Neighbor]) -> None:
-    global HALTED
-    round_counter = 0
-    accept_counter = 0
+    def close(self) -> None:
+        self.closed = True
+        self.ready.set()
+
+def cli_writer(output_queue: OutputQueue) -> None:
+    '''
+    Writes each batch of queued messages to stdout with one write and one flush.
+    '''
+    renderer = Renderer()
     while True:
-        # check the halting condition
-        with lock:
-            if HALTED:
-                dump_to_stderr(make_header() + f' listener rounds = {round_counter}' +
-                               f' listener accepts = {accept_counter}\n')
+        output_queue.ready.wait()
+        closed = output_queue.closed
+        batch = output_queue.take()
+        if batch:
+            sys.stdout.write(''.join([renderer.render(packet) for packet in batch]))
+            sys.stdout.flush()
+        if closed:
+            return
+
+class Histogram:
+    '''
+    Counts durations (in seconds) in the fixed HISTOGRAM_BUCKETS_SECONDS
+    (and one more bucket for longer durations).
+    '''
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS_SECONDS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS_SECONDS, seconds)] += 1
+        self.total += seconds
+
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def cumulative_counts(self) -> list[tuple[str, int]]:
+        bounds = [str(bound) for bound in HISTOGRAM_BUCKETS_SECONDS] + ['+Inf']
+        return list(zip(bounds, itertools.accumulate(self.counts)))
+
+class InstrumentedSelector(selectors.DefaultSelector):
+    '''
+    A selector that times its waits, for an event loop made with
+    "asyncio.SelectorEventLoop(InstrumentedSelector(histogram))".
+    '''
+    def __init__(self, histogram: Histogram):
+        super().__init__()
+        self.histogram = histogram
+
+    def select(self, timeout: typing.Union[None, float] = None) -> list:
+        start = time.perf_counter()
+        ready = super().select(timeout)
+        self.histogram.observe(time.perf_counter() - start)
+        return ready
+
+def format_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    '''
+    The metrics of a node: a histogram per relay phase (filled in while the node runs)
+    and the counters and gauges the node keeps anyway (read when the metrics are exported).
+    '''
+    def __init__(self, node: 'Node'):
+        self.node = node
+        self.started = time.monotonic()
+        for phase in METRIC_PHASES:
+            setattr(self, phase, Histogram())
+
+    def counters(self) -> list[tuple[str, str, int]]:
+        node = self.node
+        return [('read_bytes_total', 'bytes received from neighbors', node.read_counter),
+                ('write_bytes_total', 'bytes sent to neighbors', node.write_counter),
+                ('accepts_total', 'connections accepted', node.accept_counter),
+                ('dropped_packets_total', 'packets dropped by the queue policy',
+                 node.drop_counter + sum(neighbor.dropped_packets for neighbor in node.neighbors)),
+                ('slow_disconnections_total', 'slow neighbors disconnected by the queue policy',
+                 node.disconnect_counter),
+                ('duplicate_packets_total', 'messages dropped as already seen',
+                 node.duplicate_counter),
+                ('repairs_total', 'reconnections to the tree after losing the parent',
+                 node.repair_counter),
+                ('messages_total', 'messages received or sent by this node',
+                 self.output.count())] + ([
+                ('hub_dropped_packets_total', 'packets dropped for the other workers of the hub',
+                 node.shards.dropped_packets)] if node.shards is not None else [])
+
+    def gauges(self) -> list[tuple[str, str, float]]:
+        uptime = time.monotonic() - self.started
+        gauges = [('uptime_seconds', 'seconds since the node started', uptime),
+                  ('neighbors', 'connected neighbors', len(self.node.neighbors)),
+                  ('congested_neighbors', 'neighbors above their high watermark',
+                   len(self.node.congested_neighbors)),
+                  ('throttled_neighbors', 'neighbors not read from until their token bucket refills',
+                   sum(neighbor.throttled for neighbor in self.node.neighbors)),
+                  ('seen_messages', 'message ids remembered for dropping duplicates',
+                   len(self.node.seen))]
+        origin = self.node.origin
+        if origin.compress_in_bytes:
+            gauges += [('compression_ratio', 'the texts this node compressed divided by the results',
+                        origin.compress_in_bytes / origin.compress_out_bytes),
+                       ('compress_seconds', 'the time this node spent compressing its messages',
+                        origin.compress_seconds)]
+        if self.node.log is not None:
+            gauges += [('logged_messages', 'messages kept in the message log', len(self.node.log)),
+                       ('log_bytes', 'the size of the message log files', self.node.log.size())]
+        if self.node.last_repair_seconds is not None:
+            gauges.append(('last_repair_seconds', 'the time the last reconnection to the tree took',
+                           self.node.last_repair_seconds))
+        if self.select_wait.count():  # only known with an InstrumentedSelector
+            gauges.append(('loop_utilization', 'the share of time the event loop was not waiting',
+                           max(0.0, 1 - self.select_wait.total / uptime)))
+        return gauges
+
+    def neighbors(self) -> list[dict]:
+        return [{'address': f'{neighbor.remote_address[0]}:{neighbor.remote_address[1]}',
+                 'protocol': neighbor.protocol,
+                 'congested': neighbor.congested,
+                 'read_buffered_bytes': len(neighbor.read_buffer),
+                 'write_buffered_bytes': len(neighbor.write_buffer),
+                 'scheduled_bytes': neighbor.scheduled_bytes,
+                 'throttled': neighbor.throttled,
+                 'compression': neighbor.compression,
+                 'compressed_bytes': neighbor.compressed_bytes,
+                 'compression_ratio': (neighbor.uncompressed_bytes / neighbor.compressed_bytes
+                                       if neighbor.compressed_bytes else None),
+                 'decompress_seconds': neighbor.decompress_seconds,
+                 'write_buffered_packets': (len(neighbor.write_buffer.chunks) +
+                                            len(neighbor.pending_packets or ())),
+                 'dropped_packets': neighbor.dropped_packets}
+                for neighbor in self.node.neighbors]
+
+    def prometheus(self) -> str:
+        '''
+        The metrics in the Prometheus text format.
+        '''
+        lines = ['# HELP p2p_tree_info the name of the node',
+                 '# TYPE p2p_tree_info gauge',
+                 f'p2p_tree_info{{name="{format_label(self.node.name)}"}} 1']
+        for name, description, value in self.counters():
+            lines += [f'# HELP p2p_tree_{name} {description}',
+                      f'# TYPE p2p_tree_{name} counter',
+                      f'p2p_tree_{name} {value}']
+        for name, description, value in self.gauges():
+            lines += [f'# HELP p2p_tree_{name} {description}',
+                      f'# TYPE p2p_tree_{name} gauge',
+                      f'p2p_tree_{name} {value}']
+        lines += ['# HELP p2p_tree_neighbor_buffered_bytes bytes buffered for a neighbor',
+                  '# TYPE p2p_tree_neighbor_buffered_bytes gauge']
+        for neighbor in self.neighbors():
+            address = format_label(neighbor['address'])
+            for direction in ('read', 'write'):
+                lines.append(f'p2p_tree_neighbor_buffered_bytes{{neighbor="{address}",'
+                             f'direction="{direction}"}} {neighbor[direction + "_buffered_bytes"]}')
+        lines += ['# HELP p2p_tree_neighbor_compression_ratio the decompressed length of the '
+                  'compressed frames sent to a neighbor divided by their bytes',
+                  '# TYPE p2p_tree_neighbor_compression_ratio gauge']
+        for neighbor in self.neighbors():
+            if neighbor['compression_ratio'] is not None:
+                lines.append(f'p2p_tree_neighbor_compression_ratio{{neighbor='
+                             f'"{format_label(neighbor["address"])}"}} {neighbor["compression_ratio"]}')
+        lines += ['# HELP p2p_tree_neighbor_decompress_seconds time spent decompressing frames '
+                  'for a neighbor that cannot read them',
+                  '# TYPE p2p_tree_neighbor_decompress_seconds counter']
+        for neighbor in self.neighbors():
+            lines.append(f'p2p_tree_neighbor_decompress_seconds{{neighbor='
+                         f'"{format_label(neighbor["address"])}"}} {neighbor["decompress_seconds"]}')
+        lines += ['# HELP p2p_tree_phase_seconds time spent in each relay phase',
+                  '# TYPE p2p_tree_phase_seconds histogram']
+        for phase in METRIC_PHASES:
+            histogram = getattr(self, phase)
+            for bound, count in histogram.cumulative_counts():
+                lines.append(f'p2p_tree_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}')
+            lines += [f'p2p_tree_phase_seconds_sum{{phase="{phase}"}} {histogram.total}',
+                      f'p2p_tree_phase_seconds_count{{phase="{phase}"}} {histogram.count()}']
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        '''
+        The metrics as a JSON-serializable dict.
+        '''
+        return {'time': time.time(),
+                'name': self.node.name,
+                'counters': {name: value for name, _, value in self.counters()},
+                'gauges': {name: value for name, _, value in self.gauges()},
+                'neighbors': self.neighbors(),
+                'phases': {phase: {'count': getattr(self, phase).count(),
+                                   'sum_seconds': getattr(self, phase).total,
+                                   'buckets': dict(getattr(self, phase).cumulative_counts())}
+                           for phase in METRIC_PHASES}}
+
+class MetricsExporter:
+    '''
+    Serves a node's metrics over HTTP, on "host:port" or on a UNIX socket (an address with a "/"):
+    "/metrics" in the Prometheus text format and "/metrics.json" as JSON.
+    It can also append a JSON snapshot (one per line) to a file every "interval_seconds".
+    '''
+    def __init__(self, address: typing.Union[None, str], json_path: typing.Union[None, str] = None,
+                 interval_seconds: float = 10):
+        self.address = address
+        self.json_path = json_path
+        self.interval_seconds = interval_seconds
+        self.metrics = None
+        self.server = None
+        self.snapshot_task = None
+
+    async def start(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+        if self.address is None:
+            pass
+        elif '/' in self.address:
+            self.server = await asyncio.start_unix_server(self.handle, self.address)
+        else:
+            host, _, port = self.address.rpartition(':')
+            self.server = await asyncio.start_server(self.handle, host or 'localhost', int(port))
+        if self.json_path is not None:
+            self.snapshot_task = asyncio.get_running_loop().create_task(self.write_snapshots())
+
+    async def close(self) -> None:
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            if '/' in self.address:
+                os.unlink(self.address)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                             METRICS_REQUEST_TIMEOUT_SECONDS)
+            path = request.split(b' ', 2)[1] if request.count(b' ') >= 2 else b''
+            if path in (b'/', b'/metrics'):
+                status = '200 OK'
+                content_type = 'text/plain; version=0.0.4'
+                body = self.metrics.prometheus().encode()
+            elif path == b'/metrics.json':
+                status = '200 OK'
+                content_type = 'application/json'
+                body = json.dumps(self.metrics.snapshot()).encode()
+            else:
+                status = '404 Not Found'
+                content_type = 'text/plain'
+                body = b'not found\n'
+            writer.write(f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, TimeoutError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def write_snapshots(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            line = json.dumps(self.metrics.snapshot()) + '\n'
+            try:
+                await loop.run_in_executor(None, self.append, line)
+            except OSError as error:
+                dump_to_stderr(make_header() + f'cannot write a metrics snapshot: {error}\n')
+
+    def append(self, line: str) -> None:
+        with open(self.json_path, 'a') as f:
+            f.write(line)
+
+class TcpListener:
+    '''
+    A listening TCP socket whose accepted sockets are ready for the event loop.
+    With "reuse_port", processes can listen on the same port and the kernel spreads
+    the connections between them.
+    '''
+    def __init__(self, address: tuple[str, int], reuse_port: bool = False):
+        self.the_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.the_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.the_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.the_socket.setblocking(False)
+        try:
+            self.the_socket.bind(address)
+            self.the_socket.listen()
+        except:
+            self.the_socket.close()
+            raise
+
+    def fileno(self) -> int:
+        return self.the_socket.fileno()
+
+    def accept(self) -> tuple[socket.socket, tuple[str, int]]:
+        '''
+        Raises BlockingIOError when no connection is pending.
+        '''
+        client_socket, client_address = self.the_socket.accept()
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        client_socket.setblocking(False)
+        return client_socket, client_address
+
+    def close(self) -> None:
+        self.the_socket.close()
+
+class TcpTransport:
+    '''
+    Connections over TCP/IPv4 (the default transport).
+    A transport opens connections ("connect") and listens for them ("listen");
+    both give non-blocking stream sockets, so the relay logic is the same for all transports.
+    '''
+    def __init__(self, reuse_port: bool = False):
+        self.reuse_port = reuse_port
+
+    async def connect(self, address: tuple[str, int]) -> tuple[socket.socket, tuple[str, int]]:
+        '''
+        Returns the connected socket and its local address.
+        '''
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        client_socket.setblocking(False)
+        try:
+            await asyncio.get_running_loop().sock_connect(client_socket, address)
+        except:
+            client_socket.close()
+            raise
+        return client_socket, client_socket.getsockname()
+
+    def listen(self, address: tuple[str, int]) -> TcpListener:
+        return TcpListener(address, self.reuse_port)
+
+class MemoryListener:
+    '''
+    A listener of a MemoryTransport. The event loop watches a socketpair that is written to
+    whenever a connection is pending.
+    '''
+    def __init__(self, transport: 'MemoryTransport', address: tuple[str, int]):
+        self.transport = transport
+        self.address = address
+        self.pending = collections.deque()  # (socket, address of the connecting side)
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def fileno(self) -> int:
+        return self.wakeup_reader.fileno()
+
+    def wake_up(self) -> None:
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:  # already readable
+            pass
+
+    def accept(self) -> tuple[socket.socket, tuple[str, int]]:
+        '''
+        Raises BlockingIOError when no connection is pending.
+        '''
+        if not self.pending:
+            raise BlockingIOError()
+        try:
+            self.wakeup_reader.recv(4096)
+        except BlockingIOError:
+            pass
+        return self.pending.popleft()
+
+    def close(self) -> None:
+        if self.transport.listeners.get(self.address) is self:
+            del self.transport.listeners[self.address]
+        for the_socket, _ in self.pending:
+            the_socket.close()
+        self.pending.clear()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+class MemoryTransport:
+    '''
+    Connections inside one process: every connection is a "socket.socketpair",
+    and addresses only have to be unique among the nodes sharing the transport.
+    The side that connects gets the address ("memory", <connection number>).
+    '''
+    def __init__(self):
+        self.listeners = {}  # address -> MemoryListener
+        self.connection_counter = 0
+
+    async def connect(self, address: tuple[str, int]) -> tuple[socket.socket, tuple[str, int]]:
+        listener = self.listeners.get(address)
+        if listener is None:
+            raise ConnectionRefusedError(f'nothing listens on {address}')
+        ours, theirs = socket.socketpair()
+        ours.setblocking(False)
+        theirs.setblocking(False)
+        self.connection_counter += 1
+        local_address = ('memory', self.connection_counter)
+        listener.pending.append((theirs, local_address))
+        listener.wake_up()
+        return ours, local_address
+
+    def listen(self, address: tuple[str, int]) -> MemoryListener:
+        if address in self.listeners:
+            raise OSError(f'{address} is already in use')
+        listener = MemoryListener(self, address)
+        self.listeners[address] = listener
+        return listener
+
+class ShardRing:
+    '''
+    A ring buffer of frames in shared memory (mapped before the workers fork)
+    with one writer and a read cursor for each reader.
+    Cursors count bytes since the start and only grow; the writer publishes a frame
+    by moving its cursor past it, and never overwrites what a reader has not read.
+    '''
+    def __init__(self, readers: int, capacity: int = HUB_RING_BYTES):
+        self.capacity = capacity
+        self.data_offset = RING_CURSOR.size * (1 + readers)
+        self.memory = mmap.mmap(-1, self.data_offset + capacity)
+
+    def write_cursor(self) -> int:
+        return RING_CURSOR.unpack_from(self.memory, 0)[0]
+
+    def read_cursor(self, reader: int) -> int:
+        return RING_CURSOR.unpack_from(self.memory, RING_CURSOR.size * (1 + reader))[0]
+
+    def write(self, frame: bytes, readers: list[int]) -> bool:
+        '''
+        Appends a frame; returns False if the slowest reader has not made room for it.
+        '''
+        write = self.write_cursor()
+        position = write % self.capacity
+        size = RING_RECORD.size + len(frame)
+        skip = self.capacity - position if size > self.capacity - position else 0
+        if write + skip + size - min(self.read_cursor(reader) for reader in readers) > self.capacity:
+            return False
+        if skip:
+            if skip >= RING_RECORD.size:
+                RING_RECORD.pack_into(self.memory, self.data_offset + position, RING_WRAP)
+            position = 0
+        start = self.data_offset + position + RING_RECORD.size
+        self.memory[start:start + len(frame)] = frame
+        RING_RECORD.pack_into(self.memory, start - RING_RECORD.size, len(frame))
+        RING_CURSOR.pack_into(self.memory, 0, write + skip + size)
+        return True
+
+    def read(self, reader: int) -> list[bytes]:
+        '''
+        Copies out the frames "reader" has not read yet.
+        '''
+        memory = self.memory
+        read = self.read_cursor(reader)
+        write = self.write_cursor()
+        frames = []
+        while read < write:
+            position = read % self.capacity
+            remaining = self.capacity - position
+            if remaining < RING_RECORD.size:
+                read += remaining
+                continue
+            length, = RING_RECORD.unpack_from(memory, self.data_offset + position)
+            if length == RING_WRAP:
+                read += remaining
+                continue
+            start = self.data_offset + position + RING_RECORD.size
+            frames.append(memory[start:start + length])
+            read += RING_RECORD.size + length
+        RING_CURSOR.pack_into(memory, RING_CURSOR.size * (1 + reader), read)
+        return frames
+
+class Shards:
+    '''
+    The worker processes of a hub node. They listen on the node's port together
+    (SO_REUSEPORT), so each one owns the neighbors whose connections the kernel gave it.
+    Every worker writes each packet it relays once to its own ring in shared memory
+    and wakes the others up through their pipes; each of them copies the packet out once
+    and queues that copy for all its neighbors.
+    Worker 0 is the node of the front-end: it owns the links to the parent and the extra links,
+    displays the messages and keeps the log and the downloads.
+    It shares its ancestors and depth with the other workers (as ANCESTORS control frames
+    in its ring) and they share the size and height of their subtrees with it (SUBTREE),
+    so the hub joins, redirects and reports its subtree like one node
+    (with "max_children" applied per worker).
+    '''
+    extra = False  # to the relay, packets from other workers come over a link of the tree
+
+    def __init__(self, workers: int, ring_bytes: int = HUB_RING_BYTES):
+        if workers < 1:
+            raise ValueError('a hub needs at least 1 worker')
+        self.workers = workers
+        self.rings = [ShardRing(workers, ring_bytes) for _ in range(workers)]
+        self.wakeups = [os.pipe() for _ in range(workers)]
+        for pipe in self.wakeups:
+            for fd in pipe:
+                os.set_blocking(fd, False)
+        self.index = 0  # of this worker
+        self.node = None
+        self.processes = []
+        self.backlog = collections.deque()  # frames waiting for space in this worker's ring
+        self.subtrees = {}  # worker -> the size and height its children add to the subtree
+        self.waking = False
+        self.dropped_packets = 0
+
+    def spawn(self, worker: typing.Callable[['Shards'], None]) -> None:
+        '''
+        Forks the workers other than worker 0 (before any event loop or thread starts).
+        '''
+        context = multiprocessing.get_context('fork')
+        for index in range(1, self.workers):
+            self.index = index
+            process = context.Process(target = self.run_worker, args = (worker,), daemon = True)
+            process.start()
+            self.processes.append(process)
+        self.index = 0
+
+    def run_worker(self, worker: typing.Callable[['Shards'], None]) -> None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # worker 0 stops the others
+        self.processes = []  # forked from worker 0, which waits for them
+        worker(self)
+
+    def readers(self) -> list[int]:
+        return [index for index in range(self.workers) if index != self.index]
+
+    def attach(self, node: 'Node') -> None:
+        self.node = node
+        node.loop.add_reader(self.wakeups[self.index][0], self.drain)
+        self.share_ancestors()
+        self.share_subtree()
+
+    def publish(self, frame: bytes) -> None:
+        '''
+        Writes a frame to this worker's ring for the other workers.
+        While frames wait for space, the worker counts as a congested neighbor,
+        so it stops reading from its neighbors until the other workers catch up.
+        Beyond HUB_BACKLOG_PACKETS (from its own messages), the oldest message is dropped;
+        control frames never are.
+        '''
+        if self.workers == 1:
+            return
+        if self.backlog or not self.rings[self.index].write(frame, self.readers()):
+            if len(self.backlog) >= HUB_BACKLOG_PACKETS:
+                for i, queued in enumerate(self.backlog):
+                    if queued[FRAME_HEADER.size - 1] != FRAME_CONTROL:
+                        del self.backlog[i]
+                        self.dropped_packets += 1
+                        break
+            self.backlog.append(frame)
+            if len(self.backlog) == 1:
+                self.node.congested_neighbors.add(self)
+                self.node.congestion_changed = True
+                self.node.loop.call_later(HUB_RETRY_SECONDS, self.retry)
+            return
+        if not self.waking:  # one wakeup per callback of the event loop
+            self.waking = True
+            self.node.loop.call_soon(self.wake)
+
+    def retry(self) -> None:
+        ring = self.rings[self.index]
+        readers = self.readers()
+        while self.backlog and ring.write(self.backlog[0], readers):
+            self.backlog.popleft()
+        self.wake()
+        if not self.backlog:
+            self.node.congested_neighbors.discard(self)
+            self.node.congestion_changed = True
+            self.node.settle()
+        elif not self.node.closed:
+            self.node.loop.call_later(HUB_RETRY_SECONDS, self.retry)
+
+    def wake(self) -> None:
+        self.waking = False
+        for index in self.readers():
+            try:
+                os.write(self.wakeups[index][1], b'\0')
+            except BlockingIOError:  # the pipe is full of wakeups already
+                pass
+
+    def drain(self) -> None:
+        '''
+        Relays the packets the other workers wrote since the last wakeup.
+        '''
+        try:
+            while os.read(self.wakeups[self.index][0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+        node = self.node
+        for index in self.readers():
+            for frame in self.rings[index].read(self.index):
+                packet = Packet(frame)
+                if packet.kind() == FRAME_CONTROL:
+                    self.control(packet, index)
+                else:
+                    node.relay(packet, self)
+        node.settle()
+
+    def control(self, packet: Packet, index: int) -> None:
+        payload = packet.payload()
+        control_type, = CONTROL_HEADER.unpack_from(payload)
+        body = json.loads(bytes(payload[CONTROL_HEADER.size:]))
+        node = self.node
+        if control_type == CONTROL_ANCESTORS and index == 0:
+            node.ancestors = [tuple(address) for address in body['ancestors']]
+            node.depth = body['depth']
+            node.advertise_ancestors()
+        elif control_type == CONTROL_SUBTREE and self.index == 0:
+            self.subtrees[index] = (body['size'], body['height'])
+            node.update_subtree()
+
+    def share_ancestors(self) -> None:
+        if self.index == 0:
+            self.publish(make_control(CONTROL_ANCESTORS, {'ancestors': self.node.ancestors,
+                                                          'depth': self.node.depth}).frame)
+
+    def share_subtree(self) -> None:
+        if self.index != 0:
+            size, height = self.node.subtree
+            self.publish(make_control(CONTROL_SUBTREE, {'size': size - 1,
+                                                        'height': height}).frame)
+
+    def close(self) -> None:
+        self.node.loop.remove_reader(self.wakeups[self.index][0])
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+def hub_worker(name: str, address: tuple[str, int], limits: QueueLimits,
+               join_policy: JoinPolicy, rate_limit: typing.Union[None, RateLimit],
+               shards: Shards) -> None:
+    '''
+    A worker process of a hub node other than worker 0; it runs until SIGTERM.
+    '''
+    node = Node(name, address, limits = limits, on_message = lambda packet: None,
+                join_policy = join_policy, rate_limit = rate_limit, shards = shards)
+    loop = asyncio.SelectorEventLoop(InstrumentedSelector(node.metrics.select_wait))
+
+    async def run() -> None:
+        stopped = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopped.set)
+        await node.start()
+        await stopped.wait()
+        await node.close()
+
+    loop.run_until_complete(run())
+    loop.close()
+
+class Node:
+    '''
+    A node of the tree. It runs on an asyncio event loop, and one loop can host many nodes.
+    The node owns its listener and all its neighbors, and is driven by the loop's
+    readiness callbacks (add_reader/add_writer), so relaying keeps using the neighbors' buffers
+    and batched sends. Connections come from "transport" (TCP by default,
+    or a MemoryTransport shared by nodes in one process).
+    Methods must be called from the loop's thread
+    (other threads can go through "loop.call_soon_threadsafe").
+    Received and sent messages go to "on_message" if it is given;
+    otherwise they are queued for "async for packet in node".
+    Over v2 links, children tell their parent their listening address (JOIN)
+    and parents tell their children their ancestors and earlier siblings,
+    so a node that loses its parent can reconnect to the tree ("repair").
+    Children also report the size and height of their subtrees,
+    which the parent uses to redirect joining nodes by "join_policy".
+    With "shards", the node is one worker of a hub node (see Shards).
+    Files ("send_file") travel as transfer frames in the neighbors' bulk flows
+    and are saved in "download_dir" (if it is given).
+    With a "log", the node keeps the messages it relays and replays them to neighbors that ask
+    (CATCHUP); with "catch_up_seconds", it asks its parent after joining for the messages
+    of that many seconds before (or, after a repair, since its last message).
+    The node closes the log when it closes.
+    With a "rate_limit", each neighbor is only read from as fast as its token bucket allows.
+    With "compression", the texts of the messages this node sends are compressed (once, here);
+    compressed messages are relayed as they are to the neighbors that announced they read them
+    (FEATURES) and decompressed only for the others, the output, and the log.
+    '''
+    def __init__(self, name: str, address: tuple[str, int],
+                 inviter_address: typing.Union[None, tuple[str, int]] = None,
+                 limits: typing.Union[None, QueueLimits] = None,
+                 on_message: typing.Union[None, typing.Callable[[Packet], None]] = None,
+                 transport: typing.Union[None, TcpTransport, MemoryTransport] = None,
+                 links: typing.Iterable[tuple[str, int]] = (),
+                 join_policy: typing.Union[None, JoinPolicy] = None,
+                 download_dir: typing.Union[None, str] = None,
+                 log: typing.Union[None, MessageLog] = None,
+                 catch_up_seconds: typing.Union[None, float] = None,
+                 rate_limit: typing.Union[None, RateLimit] = None,
+                 shards: typing.Union[None, Shards] = None, compression: bool = False):
+        self.name = name
+        self.address = address
+        self.inviter_address = inviter_address
+        self.limits = QueueLimits() if limits is None else limits
+        self.on_message = on_message
+        self.messages = asyncio.Queue() if on_message is None else None
+        self.origin = Origin(name)
+        self.shards = shards
+        self.transport = TcpTransport(reuse_port = shards is not None) if transport is None else transport
+        self.links = list(links)  # addresses to keep extra links to (besides the tree)
+        self.seen = SeenMessages()
+        self.parent = None  # the neighbor this node joined the tree through
+        self.ancestors = []  # listening addresses above this node, nearest (the parent) first
+        self.siblings = []  # listening addresses of the parent's children that joined earlier
+        self.depth = 0  # the number of ancestors
+        self.subtree = (1, 0)  # the size and height of this node's subtree (as last reported)
+        self.redirects = 0  # redirects followed since this node was last accepted as a child
+        self.join_policy = JoinPolicy() if join_policy is None else join_policy
+        self.repair_task = None
+        self.held_joins = []  # (neighbor, JOIN body) received before this node knew its depth
+        self.held_joins_timer = None
+        self.download_dir = download_dir
+        self.downloads = {}  # (sender id, transfer number) -> Download
+        self.downloads_timer = None
+        self.transfer_tasks = set()  # the files being sent
+        self.transfer_counter = 0
+        self.log = log
+        self.catch_up_seconds = catch_up_seconds
+        self.last_message_milliseconds = None  # when the last message arrived (or was sent)
+        self.rate_limit = rate_limit
+        self.compression = compression
+        self.loop = None
+        self.listener = None
+        self.neighbors = []
+        self.handshake_timers = {}  # neighbor -> the timer that ends its handshake
+        self.congested_neighbors = set()  # neighbors whose feeders are not read from
+        self.congestion_changed = False
+        self.slow_neighbors = []  # neighbors to be disconnected by the queue policy
+        self.closed = False
+        self.accept_counter = 0
+        self.read_counter = 0
+        self.write_counter = 0
+        self.drop_counter = 0  # packets dropped for neighbors that are gone
+        self.disconnect_counter = 0  # slow neighbors disconnected by the queue policy
+        self.duplicate_counter = 0  # messages that arrived again over another link
+        self.repair_counter = 0  # reconnections after losing the parent
+        self.last_repair_seconds = None  # from losing the parent to reconnecting
+        self.metrics = Metrics(self)
+
+    async def start(self) -> None:
+        '''
+        Connects to the inviter (if any) and starts accepting connections.
+        '''
+        self.loop = asyncio.get_running_loop()
+        if self.inviter_address:
+            client_socket, local_address = await asyncio.wait_for(
+                self.transport.connect(self.inviter_address), SOCKET_CONNECTION_TIMEOUT_SECONDS)
+            dump_to_stderr(make_header() + f'connected to the inviter ({self.inviter_address})\n')
+            self.parent = Neighbor(client_socket, self.inviter_address, self.limits,
+                                   initiator = True, local_address = local_address)
+            self.ancestors = [self.inviter_address]
+            self.add_neighbor(self.parent)
+        self.listener = self.transport.listen(self.address)
+        self.loop.add_reader(self.listener, self.accept)
+        if self.shards is not None:
+            self.shards.attach(self)
+        for address in self.links:
+            try:
+                link_socket, local_address = await asyncio.wait_for(
+                    self.transport.connect(address), SOCKET_CONNECTION_TIMEOUT_SECONDS)
+            except (OSError, TimeoutError) as error:
+                dump_to_stderr(make_header() + f'cannot link to {address}: {error}\n')
+                continue
+            dump_to_stderr(make_header() + f'linked to {address}\n')
+            self.add_neighbor(Neighbor(link_socket, address, self.limits, initiator = True,
+                                       local_address = local_address, extra = True))
+
+    def send(self, text: str) -> Packet:
+        '''
+        Sends a message from this node to the whole tree (and to its own output).
+        A text too long for a frame is sent as several messages; returns the last one.
+        '''
+        for piece in self.origin.split_text(text):
+            packet = self.origin.make_message(piece, self.compression)
+            self.relay(packet, None)
+        self.settle()
+        return packet
+
+    def send_batch(self, texts: typing.Iterable[typing.Union[str, bytes]]) -> int:
+        '''
+        Sends many messages (encoded texts are sent as they are, split like in "send"),
+        applying the queue policy decisions once for the batch. Returns the number sent.
+        '''
+        count = 0
+        for text in texts:
+            for piece in self.origin.split_text(text):
+                self.relay(self.origin.make_message(piece, self.compression), None)
+                count += 1
+        self.settle()
+        return count
+
+    def send_file(self, path: str) -> asyncio.Task:
+        '''
+        Starts sending a file to the whole tree; the task ends once it is queued.
+        '''
+        task = self.loop.create_task(self.transfer(path))
+        self.transfer_tasks.add(task)
+        task.add_done_callback(self.transfer_tasks.discard)
+        return task
+
+    async def transfer(self, path: str) -> None:
+        '''
+        Reads a file in chunks (off the event loop) and relays them as transfer frames.
+        The transfer has a window: it waits while any neighbor has more than
+        TRANSFER_WINDOW_BYTES queued, so it only ever holds a window of the file in memory,
+        and relayers apply their queue policy to the rest of the way.
+        '''
+        try:
+            with open(path, 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                self.transfer_counter = (self.transfer_counter + 1) & 0xFFFFFFFF
+                number = self.transfer_counter
+                file_name = os.path.basename(path)
+                self.relay_transfer(number, 0, TRANSFER_BEGIN, json.dumps(
+                    {'name': self.name, 'file': file_name, 'size': size,
+                     'chunk_bytes': TRANSFER_CHUNK_BYTES}).encode())
+                digest = hashlib.sha256()
+                for index in itertools.count():
+                    chunk = await self.loop.run_in_executor(None, file.read, TRANSFER_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    while any(neighbor.queued_bytes() > TRANSFER_WINDOW_BYTES
+                              for neighbor in self.neighbors):
+                        await asyncio.sleep(TRANSFER_POLL_SECONDS)
+                    self.relay_transfer(number, index, TRANSFER_CHUNK, chunk)
+                self.relay_transfer(number, 0, TRANSFER_END,
+                                    json.dumps({'sha256': digest.hexdigest()}).encode())
+        except OSError as error:
+            dump_to_stderr(make_header() + f'cannot send the file {path}: {error}\n')
+            return
+        dump_to_stderr(make_header() + f'sent the file {path} ({size} bytes)\n')
+
+    def relay_transfer(self, number: int, index: int, part: int, body: bytes) -> None:
+        header = TRANSFER_HEADER.pack(self.origin.sender_id, number, index, part)
+        self.relay(Packet(make_frame(FRAME_TRANSFER, header + body)), None)
+        self.settle()
+
+    def receive_transfer(self, packet: Packet, source: typing.Union[None, Neighbor]) -> None:
+        '''
+        Announces, saves (into "download_dir") and checks the files sent by others.
+        '''
+        payload = packet.payload()
+        sender_id, number, index, part = TRANSFER_HEADER.unpack_from(payload)
+        body = payload[TRANSFER_HEADER.size:]
+        key = (sender_id, number)
+        if part == TRANSFER_CHUNK:
+            download = self.downloads.get(key)
+            if download is None:
+                return
+            if not download.write(index, body):
+                self.abort_download(key, 'missed a part of')
                 return
-        # try to accept new connections
+            download.source = source
+            download.active = time.monotonic()
+            return
         try:
-            client_socket, client_address = server_socket.accept()
-            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            client_socket.settimeout(SOCKET_OPERATION_TIMEOUT_SECONDS)
-            with lock:
-                neighbors.append(Neighbor(client_socket, client_address, b'', b''))
+            info = json.loads(bytes(body))
+        except ValueError:
+            return
+        if part == TRANSFER_BEGIN:
+            try:
+                name, file_name, size, chunk_bytes = (
+                    str(info['name']), str(info['file']), int(info['size']), int(info['chunk_bytes']))
+            except (KeyError, TypeError, ValueError):
+                return
+            self.output(Packet(make_frame(FRAME_TEXT, (
+                make_header(name) + f'sent the file "{file_name}" ({size} bytes)').encode())))
+            if (self.download_dir is None or sender_id == self.origin.sender_id or
+                size < 0 or chunk_bytes <= 0):
+                return
+            try:
+                self.downloads[key] = Download(unused_path(self.download_dir, file_name),
+                                               size, chunk_bytes, source)
+            except OSError as error:
+                dump_to_stderr(make_header() + f'cannot save the file "{file_name}": {error}\n')
+            self.watch_downloads()
+        elif part == TRANSFER_END:
+            download = self.downloads.pop(key, None)
+            if download is None:
+                return
+            try:
+                saved = download.finish(str(info.get('sha256')))
+            except OSError as error:
+                dump_to_stderr(make_header() + f'cannot save {download.path}: {error}\n')
+                return
+            if saved:
+                dump_to_stderr(make_header() + f'saved {download.path}\n')
+            else:
+                dump_to_stderr(make_header() + f'received a damaged copy of {download.path}\n')
+
+    def abort_download(self, key: tuple[int, int], reason: str) -> None:
+        download = self.downloads.pop(key)
+        download.abort()
+        dump_to_stderr(make_header() + f'{reason} {download.path}\n')
+
+    def watch_downloads(self) -> None:
+        '''
+        Checks for stalled downloads once the least recently active one could have stalled.
+        '''
+        if self.downloads and self.downloads_timer is None and not self.closed:
+            active = min(download.active for download in self.downloads.values())
+            self.downloads_timer = self.loop.call_later(
+                active + TRANSFER_IDLE_SECONDS - time.monotonic(), self.check_downloads)
+
+    def check_downloads(self) -> None:
+        '''
+        Gives up the downloads that got no part for TRANSFER_IDLE_SECONDS
+        (their sender may have stopped without an END), deleting their partial files.
+        '''
+        self.downloads_timer = None
+        now = time.monotonic()
+        for key, download in list(self.downloads.items()):
+            if now - download.active >= TRANSFER_IDLE_SECONDS:
+                self.abort_download(key, 'gave up the stalled download of')
+        self.watch_downloads()
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.repair_task is not None:
+            self.repair_task.cancel()
+            await asyncio.gather(self.repair_task, return_exceptions = True)
+        if self.held_joins_timer is not None:
+            self.held_joins_timer.cancel()
+        for task in list(self.transfer_tasks):
+            task.cancel()
+        await asyncio.gather(*self.transfer_tasks, return_exceptions = True)
+        if self.downloads_timer is not None:
+            self.downloads_timer.cancel()
+        for download in self.downloads.values():
+            download.abort()
+        self.downloads.clear()
+        if self.listener is not None:
+            self.loop.remove_reader(self.listener)
+            self.listener.close()
+        for neighbor in list(self.neighbors):
+            self.remove_neighbor(neighbor)
+        if self.log is not None:
+            self.log.close()
+        if self.shards is not None and self.shards.node is self:
+            self.shards.close()
+        if self.messages is not None:
+            self.messages.put_nowait(None)  # ends "async for"
+        dump_to_stderr(make_header() + f' relayer read bytes = {self.read_counter}' +
+                       f' relayer write bytes = {self.write_counter}' +
+                       f' relayer dropped packets = {self.drop_counter}' +
+                       f' relayer duplicate packets = {self.duplicate_counter}' +
+                       f' relayer slow disconnections = {self.disconnect_counter}' +
+                       f' listener accepts = {self.accept_counter}' +
+                       (f' hub dropped packets = {self.shards.dropped_packets}'
+                        if self.shards is not None else '') + '\n')
+
+    def __aiter__(self) -> 'Node':
+        return self
+
+    async def __anext__(self) -> Packet:
+        packet = await self.messages.get()
+        if packet is None:
+            raise StopAsyncIteration
+        return packet
+
+    def output(self, packet: Packet) -> None:
+        if self.on_message is not None:
+            self.on_message(packet)
+        else:
+            self.messages.put_nowait(packet)
+
+    def add_neighbor(self, neighbor: Neighbor) -> None:
+        self.neighbors.append(neighbor)
+        self.handshake_timers[neighbor] = self.loop.call_at(
+            neighbor.handshake_deadline, self.end_handshake, neighbor)
+        self.update_interest(neighbor)
+
+    def remove_neighbor(self, neighbor: Neighbor) -> None:
+        self.neighbors.remove(neighbor)
+        if neighbor.events & selectors.EVENT_READ:
+            self.loop.remove_reader(neighbor.the_socket)
+        if neighbor.events & selectors.EVENT_WRITE:
+            self.loop.remove_writer(neighbor.the_socket)
+        neighbor.events = 0
+        timer = self.handshake_timers.pop(neighbor, None)
+        if timer is not None:
+            timer.cancel()
+        if neighbor.replay is not None:
+            neighbor.replay.close()
+            neighbor.replay = None
+        neighbor.the_socket.close()
+        self.drop_counter += neighbor.dropped_packets
+        if neighbor in self.congested_neighbors:
+            self.congested_neighbors.discard(neighbor)
+            self.congestion_changed = True
+        if self.closed:
+            return
+        for key, download in list(self.downloads.items()):
+            if download.source is neighbor:  # the rest of the file cannot arrive in order
+                self.abort_download(key, 'lost the link to the sender of')
+        if neighbor is self.parent:
+            self.parent = None
+            self.repair_task = self.loop.create_task(self.repair())
+        elif neighbor.child:
+            self.advertise_siblings()
+            self.update_subtree()
+
+    def update_interest(self, neighbor: Neighbor) -> None:
+        '''
+        Watch a neighbor for writability only while it has pending output;
+        idle sockets are almost always writable and would make the loop spin.
+        Stop watching a neighbor for readability while it feeds a congested neighbor
+        or is out of tokens, so that TCP pushes back on the senders.
+        '''
+        congested_neighbors = self.congested_neighbors
+        paused = neighbor.throttled or (bool(congested_neighbors) and not (
+            len(congested_neighbors) == 1 and neighbor in congested_neighbors))
+        events = ((0 if paused else selectors.EVENT_READ) |
+                  (selectors.EVENT_WRITE if neighbor.write_buffer else 0))
+        changed = events ^ neighbor.events
+        if changed & selectors.EVENT_READ:
+            if events & selectors.EVENT_READ:
+                self.loop.add_reader(neighbor.the_socket, self.receive, neighbor)
+            else:
+                self.loop.remove_reader(neighbor.the_socket)
+        if changed & selectors.EVENT_WRITE:
+            if events & selectors.EVENT_WRITE:
+                self.loop.add_writer(neighbor.the_socket, self.flush, neighbor)
+            else:
+                self.loop.remove_writer(neighbor.the_socket)
+        neighbor.events = events
+
+    def update_queue_state(self, neighbor: Neighbor) -> None:
+        if neighbor.overflowed:
+            self.slow_neighbors.append(neighbor)
+        if neighbor.congested != (neighbor in self.congested_neighbors):
+            if neighbor.congested:
+                self.congested_neighbors.add(neighbor)
+            else:
+                self.congested_neighbors.discard(neighbor)
+            self.congestion_changed = True
+
+    def settle(self) -> None:
+        '''
+        Applies the queue policy decisions of the last callback:
+        disconnects slow neighbors and pauses or resumes reading after a change of congestion.
+        '''
+        while self.slow_neighbors:
+            neighbor = self.slow_neighbors.pop()
+            if neighbor in self.neighbors:
                 dump_to_stderr(make_header() +
-                               f'accepted a new connection from {client_address}\n')
-            accept_counter += 1
-        except TimeoutError:
-            pass
-        # round counter update
-        round_counter += 1
+                               f'disconnected the slow neighbor {neighbor.remote_address}\n')
+                self.disconnect_counter += 1
+                self.remove_neighbor(neighbor)
+        if self.congestion_changed:
+            self.congestion_changed = False
+            for neighbor in self.neighbors:
+                self.update_interest(neighbor)
 
-def listener(lock: threading.Lock, server_socket: socket.socket,
-             neighbors: list[Neighbor]) -> None:
-    global HALTED
-    try:
-        listener_core(lock, server_socket, neighbors)
-    except:  # when one thread throws exceptions, let all other threads terminate through HALTED
-        with lock:
-            HALTED = True
-
-def relayer_core(lock: threading.Lock, neighbors: list[Neighbor],
-                 output: typing.Callable[[str], None]) -> None:
-    global PACKET_LENGTH_BYTES, HALTED
-    round_counter = 0
-    read_counter = 0
-    write_counter = 0
-    while True:
-        # avoid busy waiting
-        time.sleep(SOCKET_OPERATION_TIMEOUT_SECONDS)
-        # check the halting condition
-        with lock:
-            if HALTED:
-                dump_to_stderr(make_header() + f' relayer rounds = {round_counter}' +
-                               f' relayer read bytes = {read_counter}' +
-                               f' relayer write bytes = {write_counter}\n')
+    def relay(self, packet: Packet, source: typing.Union[None, Neighbor]) -> None:
+        '''
+        Prints a packet (or hands a transfer frame to "receive_transfer")
+        and queues it for all neighbors except the one it came from.
+        Messages that have been seen before (over another link) are dropped.
+        Plain text has no id, so it only travels the links of the tree.
+        '''
+        message_id = packet.message_id()
+        if message_id is not None:
+            if not self.seen.add(message_id, time.monotonic()):
+                self.duplicate_counter += 1
                 return
-        # freeze and obtain a list of current sockets
-        # note: the listener may add new neighbor objects to "neighbors"
-        # during this round of relayer
-        with lock:
-            socket_list = [neighbor.the_socket for neighbor in neighbors]
-        if socket_list:
-            readable_socket_list, writable_socket_list, exceptional_socket_list = select.select(
-                socket_list, socket_list, socket_list, SELECT_TIMEOUT_SECONDS)
+        elif source is not None and source.extra:
+            return
+        metrics = self.metrics
+        start = time.perf_counter()
+        kind = packet.kind()
+        if kind != FRAME_TRANSFER:
+            self.output(packet)
         else:
-            continue
-        # prepare variables
-        reads = {}
-        writes = {}
-        writable_socket_id_set = set([id(the_socket) for the_socket in writable_socket_list])
-        # read data and detect dead sockets
-        dead_socket_list = []
-        for the_socket in readable_socket_list:
-            data = the_socket.recv(PACKET_LENGTH_BYTES)
-            if data == b'':
-                dead_socket_list.append(the_socket)
+            self.receive_transfer(packet, source)
+        if ((kind == FRAME_MESSAGE or kind == FRAME_COMPRESSED) and
+            (self.log is not None or self.catch_up_seconds is not None)):
+            milliseconds = time.time_ns() // 1000000
+            self.last_message_milliseconds = milliseconds
+            if self.log is not None:
+                try:  # decompressed, so any neighbor can be sent a replay
+                    self.log.append(packet.plain(), milliseconds)
+                except OSError as error:
+                    dump_to_stderr(make_header() + f'stopped logging messages: {error}\n')
+                    self.log.close()
+                    self.log = None
+        output = time.perf_counter()
+        metrics.output.observe(output - start)
+        for other in self.neighbors:
+            if other is not source and not (other.extra and message_id is None):
+                other.enqueue(packet)  # one packet object is shared by all write buffers
+                self.update_queue_state(other)
+                self.update_interest(other)
+        if self.shards is not None and source is not self.shards:
+            self.shards.publish(packet.frame)
+        metrics.fanout.observe(time.perf_counter() - output)
+
+    def accept(self) -> None:
+        '''
+        Accepts all pending connections.
+        '''
+        while True:
+            try:
+                client_socket, client_address = self.listener.accept()
+            except BlockingIOError:
+                return
+            self.add_neighbor(Neighbor(client_socket, client_address, self.limits))
+            dump_to_stderr(make_header() + f'accepted a new connection from {client_address}\n')
+            self.accept_counter += 1
+
+    def receive(self, neighbor: Neighbor) -> None:
+        '''
+        Receives all available data (up to a limit) directly into the read buffer,
+        then prints and relays all whole packets.
+        '''
+        metrics = self.metrics
+        start = time.perf_counter()
+        dead = False
+        total = 0
+        for _ in range(RECEIVES_PER_ROUND):
+            with neighbor.read_buffer.free_space() as free_space:
+                try:
+                    received = neighbor.the_socket.recv_into(free_space)
+                except BlockingIOError:
+                    break
+                except ConnectionError:
+                    received = 0
+                full = (received == len(free_space))
+            if received == 0:
+                dead = True
+                break
+            neighbor.read_buffer.commit(received)
+            self.read_counter += received
+            total += received
+            if not full:  # the socket has been drained
+                break
+        if self.rate_limit is not None and total:
+            self.take_tokens(neighbor, total)
+        received = time.perf_counter()
+        metrics.recv.observe(received - start)
+        try:
+            packets = neighbor.receive_packets()
+        except ProtocolError as error:
+            dump_to_stderr(make_header() +
+                           f'received a malformed {error} from {neighbor.remote_address}\n')
+            packets = []
+            dead = True
+        metrics.parse.observe(time.perf_counter() - received)
+        if neighbor.protocol is not None and neighbor in self.handshake_timers:
+            self.end_handshake(neighbor)
+            if neighbor not in self.neighbors:
+                self.settle()
+                return
+        for packet in packets:
+            if packet.kind() == FRAME_CONTROL:
+                self.control(packet, neighbor)
             else:
-                reads[id(the_socket)] = data
-                read_counter += len(data)
-        # save reads to buffers, print whole packets, relay printed packets, collect writes
-        with lock:
-            for neighbor in neighbors:
-                socket_id = id(neighbor.the_socket)
-                if socket_id in reads:
-                    neighbor.read_buffer += reads[socket_id]
-                if len(neighbor.read_buffer) >= PACKET_LENGTH_BYTES:
-                    packet = neighbor.read_buffer[:PACKET_LENGTH_BYTES]
-                    neighbor.read_buffer = neighbor.read_buffer[PACKET_LENGTH_BYTES:]
-                    message = packet.decode().strip() + '\n'
-                    output(message)
-                    for other in neighbors:
-                        if id(other.the_socket) != socket_id:  # to be sent to "other" neighbors
-                            other.write_buffer += packet
-            for neighbor in neighbors:
-                socket_id = id(neighbor.the_socket)
-                if (socket_id in writable_socket_id_set) and neighbor.write_buffer:
-                    writes[socket_id] = neighbor.write_buffer
-                    neighbor.write_buffer = b''
-        # write data
-        for the_socket in writable_socket_list:
-            socket_id = id(the_socket)
-            if socket_id in writes:
-                sent = the_socket.send(writes[socket_id])
-                writes[socket_id] = writes[socket_id][sent:]
-                write_counter += sent
-        # store back not-written parts
-        with lock:
-            for neighbor in neighbors:
-                socket_id = id(neighbor.the_socket)
-                if socket_id in writes:
-                    # prepend the old data to the beginning
-                    neighbor.write_buffer = writes[socket_id] + neighbor.write_buffer
-        # detect disconnections and update the neighbor list
-        dead_socket_id_set = set([id(the_socket) for the_socket in dead_socket_list] +
-                                 [id(the_socket) for the_socket in exceptional_socket_list])
-        with lock:
-            remaining_neighbors = []
-            for neighbor in neighbors:
-                if id(neighbor.the_socket) in dead_socket_id_set:
-                    dump_to_stderr(make_header() +
-                                   f'detected the disconnection of {neighbor.remote_address}\n')
+                self.relay(packet, neighbor)
+        if dead:
+            dump_to_stderr(make_header() +
+                           f'detected the disconnection of {neighbor.remote_address}\n')
+            self.remove_neighbor(neighbor)
+        self.settle()
+
+    def take_tokens(self, neighbor: Neighbor, size: int) -> None:
+        '''
+        Takes "size" bytes from a neighbor's token bucket and stops reading from the neighbor
+        until the bucket is no longer in debt.
+        '''
+        rate_limit = self.rate_limit
+        now = self.loop.time()
+        if neighbor.tokens is None:
+            neighbor.tokens = rate_limit.burst_bytes
+        else:
+            neighbor.tokens = min(rate_limit.burst_bytes, neighbor.tokens +
+                                  (now - neighbor.tokens_updated) * rate_limit.rate_bytes)
+        neighbor.tokens -= size
+        neighbor.tokens_updated = now
+        if neighbor.tokens < 0 and not neighbor.throttled:
+            neighbor.throttled = True
+            self.loop.call_later(-neighbor.tokens / rate_limit.rate_bytes, self.unthrottle, neighbor)
+            self.update_interest(neighbor)
+
+    def unthrottle(self, neighbor: Neighbor) -> None:
+        neighbor.throttled = False
+        if neighbor in self.neighbors:
+            self.update_interest(neighbor)
+
+    def flush(self, neighbor: Neighbor) -> None:
+        '''
+        Writes data until the socket stops accepting it.
+        '''
+        start = time.perf_counter()
+        write_buffer = neighbor.write_buffer
+        while True:
+            neighbor.refill()
+            if not write_buffer:
+                break
+            try:
+                sent, complete = write_buffer.send_to(neighbor.the_socket)
+            except BlockingIOError:
+                break
+            except ConnectionError:
+                dump_to_stderr(make_header() +
+                               f'detected the disconnection of {neighbor.remote_address}\n')
+                self.remove_neighbor(neighbor)
+                self.settle()
+                return
+            self.write_counter += sent
+            if not complete:
+                break
+        self.metrics.send.observe(time.perf_counter() - start)
+        neighbor.sent()
+        self.update_queue_state(neighbor)
+        self.update_interest(neighbor)
+        self.settle()
+
+    def end_handshake(self, neighbor: Neighbor) -> None:
+        '''
+        Called when a neighbor negotiated its protocol or its handshake timed out.
+        '''
+        self.handshake_timers.pop(neighbor).cancel()
+        neighbor.check_handshake(self.loop.time())
+        if neighbor.extra and neighbor.protocol == PROTOCOL_LEGACY:
+            # legacy nodes would relay the messages around the loop the extra link makes
+            dump_to_stderr(make_header() +
+                           f'closed the extra link to the legacy node {neighbor.remote_address}\n')
+            self.remove_neighbor(neighbor)
+            self.settle()
+            return
+        self.send_control(neighbor, CONTROL_FEATURES, {'compression': [COMPRESSION_ZLIB]})
+        if neighbor.initiator and neighbor.protocol == PROTOCOL_FRAMED:
+            self.send_control(neighbor, CONTROL_JOIN,
+                              {'address': list(self.address), 'extra': neighbor.extra,
+                               'size': self.subtree[0], 'height': self.subtree[1],
+                               'redirects': self.redirects})
+        self.update_queue_state(neighbor)
+        self.update_interest(neighbor)
+        self.settle()
+
+    def send_control(self, neighbor: Neighbor, control_type: int, body: dict) -> None:
+        if neighbor.protocol != PROTOCOL_FRAMED:  # legacy nodes would display it
+            return
+        neighbor.enqueue(make_control(control_type, body))
+        self.update_queue_state(neighbor)
+        self.update_interest(neighbor)
+
+    def control(self, packet: Packet, neighbor: Neighbor) -> None:
+        '''
+        Handles a control frame from a neighbor.
+        '''
+        payload = packet.payload()
+        control_type, = CONTROL_HEADER.unpack_from(payload)
+        try:
+            body = json.loads(bytes(payload[CONTROL_HEADER.size:]))
+            if control_type == CONTROL_JOIN and not neighbor.initiator:
+                host, port = body['address']
+                if host in ('', '0.0.0.0'):  # listening on all interfaces
+                    host = neighbor.remote_address[0]
+                neighbor.listen_address = (host, port)
+                if body['extra']:
+                    neighbor.extra = True
+                    return
+                if self.placing():
+                    self.hold_join(neighbor, body)
                 else:
-                    remaining_neighbors.append(neighbor)
-            neighbors.clear()
-            neighbors.extend(remaining_neighbors)  # cannot use '=' because that's re-binding
-        # round counter update
-        round_counter += 1
-
-def relayer(lock: threading.Lock, neighbors: list[Neighbor],
-            output: typing.Callable[[str], None]) -> None:
-    global HALTED
-    try:
-        relayer_core(lock, neighbors, output)
-    except:  # when one thread throws exceptions, let all other threads terminate through HALTED
-        with lock:
-            HALTED = True
-
-def stop_and_wait(lock: threading.Lock,
-                 listener_thread: typing.Union[None, threading.Thread],
-                 relayer_thread: typing.Union[None, threading.Thread]) -> None:
-    global HALTED
-    with lock:
-        HALTED = True
-    if listener_thread:
-        listener_thread.join()
-    if relayer_thread:
-        relayer_thread.join()
-
-def gui_loop(name: str, neighbors: list[Neighbor], lock: threading.Lock,
-             listener_thread: typing.Union[None, threading.Thread]) -> None:
+                    self.answer_join(neighbor, body)
+            elif control_type == CONTROL_ANCESTORS and neighbor is self.parent:
+                if self.depth == 0:  # accepted by a new parent
+                    self.catch_up(neighbor)
+                self.ancestors = [neighbor.listen_address] + [
+                    tuple(address) for address in body['ancestors']][:ANCESTORS_KEPT - 1]
+                self.depth = body['depth'] + 1
+                self.redirects = 0
+                self.advertise_ancestors()
+                self.answer_held_joins()
+            elif control_type == CONTROL_SIBLINGS and neighbor is self.parent:
+                self.siblings = [tuple(address) for address in body['siblings']]
+            elif control_type == CONTROL_SUBTREE and neighbor.child:
+                neighbor.subtree_size = body['size']
+                neighbor.subtree_height = body['height']
+                self.update_subtree()
+            elif control_type == CONTROL_REDIRECT and neighbor is self.parent:
+                self.redirect(neighbor, tuple(body['address']))
+            elif control_type == CONTROL_CATCHUP and self.log is not None:
+                if neighbor.replay is not None:
+                    neighbor.replay.close()
+                count, neighbor.replay = self.log.replay(int(body['since']))
+                dump_to_stderr(make_header() +
+                               f'replaying {count} messages to {neighbor.remote_address}\n')
+                neighbor.refill()
+                self.update_queue_state(neighbor)
+                self.update_interest(neighbor)
+            elif control_type == CONTROL_FEATURES:
+                neighbor.compression = COMPRESSION_ZLIB in body['compression']
+            # note: controls of unknown types are skipped for forward compatibility
+        except (ValueError, TypeError, KeyError) as error:
+            dump_to_stderr(make_header() + f'received a malformed control frame ({error!r}) '
+                           f'from {neighbor.remote_address}\n')
+
+    def catch_up(self, parent: Neighbor) -> None:
+        '''
+        Asks a new parent for the messages this node missed (if "catch_up_seconds" is set).
+        '''
+        if self.catch_up_seconds is None:
+            return
+        if self.last_message_milliseconds is None:
+            since = time.time_ns() // 1000000 - int(self.catch_up_seconds * 1000)
+        else:
+            since = self.last_message_milliseconds - CATCH_UP_SLACK_MILLISECONDS
+        self.send_control(parent, CONTROL_CATCHUP, {'since': since})
+
+    def children(self) -> list[Neighbor]:
+        return [neighbor for neighbor in self.neighbors if neighbor.child]
+
+    def advertise_ancestors(self) -> None:
+        for child in self.children():
+            self.send_control(child, CONTROL_ANCESTORS,
+                              {'ancestors': self.ancestors, 'depth': self.depth})
+        if self.shards is not None:
+            self.shards.share_ancestors()
+
+    def advertise_siblings(self) -> None:
+        '''
+        Tells every child the children that joined before it,
+        the only siblings it may reconnect to (which keeps the tree free of loops).
+        '''
+        children = self.children()
+        for i, child in enumerate(children):
+            self.send_control(child, CONTROL_SIBLINGS,
+                              {'siblings': [c.listen_address for c in children[:i]]})
+
+    def update_subtree(self) -> None:
+        '''
+        Recomputes the size and height of this node's subtree and reports changes to the parent.
+        '''
+        parts = [(child.subtree_size, child.subtree_height + 1) for child in self.children()]
+        if self.shards is not None:
+            parts += self.shards.subtrees.values()  # the children of the other workers of a hub
+        subtree = (1 + sum(size for size, _ in parts), max([height for _, height in parts], default = 0))
+        if subtree != self.subtree:
+            self.subtree = subtree
+            if self.parent is not None:
+                self.send_control(self.parent, CONTROL_SUBTREE,
+                                  {'size': subtree[0], 'height': subtree[1]})
+            if self.shards is not None:
+                self.shards.share_subtree()
+
+    def answer_join(self, neighbor: Neighbor, body: dict) -> None:
+        '''
+        Accepts a joining node as a child or redirects it (see "place").
+        '''
+        target = self.place(body['height'], body['redirects'])
+        if target is not None:  # the joining node closes the connection
+            self.send_control(neighbor, CONTROL_REDIRECT, {'address': list(target)})
+            return
+        neighbor.child = True
+        neighbor.subtree_size = body['size']
+        neighbor.subtree_height = body['height']
+        self.send_control(neighbor, CONTROL_ANCESTORS,
+                          {'ancestors': self.ancestors, 'depth': self.depth})
+        self.advertise_siblings()
+        self.update_subtree()
+
+    def placing(self) -> bool:
+        '''
+        Whether this node is (re)joining the tree and does not know its depth yet:
+        it is reconnecting, or its parent (unless legacy) has not sent ANCESTORS.
+        '''
+        if self.repair_task is not None and not self.repair_task.done():
+            return True
+        return (self.parent is not None and self.depth == 0 and
+                self.parent.protocol != PROTOCOL_LEGACY)
+
+    def hold_join(self, neighbor: Neighbor, body: dict) -> None:
+        '''
+        Holds a JOIN until this node knows its depth, so "place" does not take it for a root,
+        but for JOIN_HOLD_SECONDS at most (in case the parent never tells it).
+        '''
+        self.held_joins.append((neighbor, body))
+        if self.held_joins_timer is None:
+            self.held_joins_timer = self.loop.call_later(JOIN_HOLD_SECONDS, self.answer_held_joins)
+
+    def answer_held_joins(self) -> None:
+        if self.held_joins_timer is not None:
+            self.held_joins_timer.cancel()
+            self.held_joins_timer = None
+        held_joins, self.held_joins = self.held_joins, []
+        for neighbor, body in held_joins:
+            if neighbor in self.neighbors:
+                self.answer_join(neighbor, body)
+        self.settle()
+
+    def place(self, height: int, redirects: int) -> typing.Union[None, tuple[str, int]]:
+        '''
+        Where a joining node with a subtree of "height" should attach:
+        None to accept it as a child, or else the address to redirect it to.
+        Redirects go up to a shallower node or down to a child whose subtree is the smallest,
+        and a redirect down never reaches a node that would redirect up again.
+        '''
+        policy = self.join_policy
+        if redirects >= JOIN_MAX_REDIRECTS:
+            return None
+        if self.depth + 1 + height > policy.max_depth and self.ancestors:
+            return self.ancestors[-1]
+        children = self.children()
+        if len(children) < policy.max_children or self.depth + 2 + height > policy.max_depth:
+            return None
+        return min(children, key = lambda child: (child.subtree_size,
+                                                  child.subtree_height)).listen_address
+
+    def redirect(self, neighbor: Neighbor, address: tuple[str, int]) -> None:
+        '''
+        Leaves a parent that redirected this node and joins where it says.
+        '''
+        dump_to_stderr(make_header() + f'redirected by ({neighbor.listen_address}) to ({address})\n')
+        self.parent = None  # so that leaving it is not repaired
+        self.ancestors = []
+        self.remove_neighbor(neighbor)
+        self.redirects += 1
+        self.repair_task = self.loop.create_task(
+            self.join([address, neighbor.listen_address], 'joined the tree at'))
+
+    async def repair(self) -> None:
+        '''
+        Reconnects to the tree after losing the parent: to the nearest live ancestor,
+        or else to a sibling that joined the parent earlier.
+        Without either, this node becomes the root of its subtree.
+        '''
+        start = time.monotonic()
+        candidates = self.ancestors[1:] + self.siblings
+        self.ancestors = []
+        self.siblings = []
+        self.depth = 0
+        if not candidates:
+            self.advertise_ancestors()
+            self.answer_held_joins()
+            return
+        if await self.join(candidates, 'reconnected to the tree at'):
+            self.repair_counter += 1
+            self.last_repair_seconds = time.monotonic() - start
+        else:
+            dump_to_stderr(make_header() + f'cannot reconnect to the tree '
+                           f'(tried {len(candidates)} ancestors and siblings)\n')
+
+    async def join(self, addresses: list[tuple[str, int]], message: str) -> bool:
+        '''
+        Connects to the first address that accepts (see "connect_any") as the new parent.
+        Falling back to a later address means a redirect could not be followed,
+        so this node then asks to be accepted without further redirects.
+        '''
+        connection = await self.connect_any(addresses)
+        if connection is None:  # a root now, at depth 0
+            self.advertise_ancestors()
+            self.answer_held_joins()
+            return False
+        the_socket, local_address, address = connection
+        dump_to_stderr(make_header() + f'{message} ({address})\n')
+        if address != addresses[0] and self.redirects:
+            self.redirects = JOIN_MAX_REDIRECTS
+        self.parent = Neighbor(the_socket, address, self.limits,
+                               initiator = True, local_address = local_address)
+        self.ancestors = [address]
+        self.add_neighbor(self.parent)
+        self.advertise_ancestors()
+        self.settle()
+        return True
+
+    async def connect_any(self, addresses: list[tuple[str, int]]) -> typing.Union[
+            None, tuple[socket.socket, tuple[str, int], tuple[str, int]]]:
+        '''
+        Connects to the first address that accepts, trying them in order of preference
+        in parallel: each attempt gets a head start of REPAIR_STAGGER_SECONDS
+        (or less if it fails sooner) before the next one begins.
+        Returns the socket, its local address and the address (or None).
+        '''
+        addresses = list(addresses)
+        attempts = {}  # task -> address
+        try:
+            while addresses or attempts:
+                if addresses:
+                    address = addresses.pop(0)
+                    attempts[self.loop.create_task(asyncio.wait_for(
+                        self.transport.connect(address),
+                        REPAIR_CONNECTION_TIMEOUT_SECONDS))] = address
+                done, _ = await asyncio.wait(
+                    attempts, timeout = REPAIR_STAGGER_SECONDS if addresses else None,
+                    return_when = asyncio.FIRST_COMPLETED)
+                for task in done:
+                    address = attempts.pop(task)
+                    if task.exception() is None:
+                        the_socket, local_address = task.result()
+                        return the_socket, local_address, address
+            return None
+        finally:
+            for task in attempts:  # the attempts that lost (or were interrupted)
+                task.cancel()
+            for result in await asyncio.gather(*attempts, return_exceptions = True):
+                if isinstance(result, tuple):
+                    result[0].close()
+
+class Ingest:
+    '''
+    Feeds the lines of a file (stdin for "-", a regular file or a FIFO) to a node as messages.
+    A thread reads large blocks and splits them into lines (empty lines are skipped,
+    and lines too long for a frame are split); the event loop sends each block as a batch.
+    At most INGEST_BATCHES blocks wait for the loop, and a block is only counted as done
+    once no neighbor is congested, so the reads stop while the tree pushes back.
+    "run" returns at the end of the file (once the neighbors' buffers are drained)
+    or on SIGINT or SIGTERM, and rates are reported every INGEST_REPORT_SECONDS.
+    '''
+    def __init__(self, node: Node, path: str):
+        self.node = node
+        self.path = path
+        self.slots = threading.Semaphore(INGEST_BATCHES)
+        self.stopped = None  # a future: True at the end of the file, False on a signal
+        self.interrupted = False
+        self.messages = 0
+        self.started = None
+        self.reported = (None, 0)  # the time and the number of messages of the last report
+        self.reporter = None
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        signals = []
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+                signals.append(signal_number)
+            except (NotImplementedError, RuntimeError):  # e.g. Windows or not the main thread
+                pass
+        self.started = time.monotonic()
+        self.reported = (self.started, 0)
+        self.reporter = loop.call_later(INGEST_REPORT_SECONDS, self.report)
+        threading.Thread(target = self.read, args = (loop,), daemon = True).start()
+        try:
+            if await self.stopped:
+                while not self.interrupted and any(
+                        neighbor.write_buffer or neighbor.pending_packets
+                        for neighbor in self.node.neighbors):
+                    await asyncio.sleep(INGEST_POLL_SECONDS)
+        finally:
+            self.reporter.cancel()
+            for signal_number in signals:
+                loop.remove_signal_handler(signal_number)
+        seconds = time.monotonic() - self.started
+        dump_to_stderr(make_header() + f'ingested {self.messages} messages in {seconds:.3f} seconds '
+                       f'({self.messages / max(seconds, 1e-9):.1f} messages/s)\n')
+
+    def read(self, loop: asyncio.AbstractEventLoop) -> None:
+        '''
+        Runs in the reader thread.
+        '''
+        max_bytes = self.node.origin.max_text_bytes()
+        try:
+            fd = sys.stdin.fileno() if self.path == '-' else os.open(self.path, os.O_RDONLY)
+            tail = b''
+            while True:
+                block = os.read(fd, INGEST_READ_BYTES)
+                if not block:
+                    lines = [tail]
+                else:
+                    lines = (tail + block).split(b'\n')
+                    tail = lines.pop()
+                    while len(tail) > max_bytes:
+                        lines.append(tail[:max_bytes])
+                        tail = tail[max_bytes:]
+                self.slots.acquire()
+                loop.call_soon_threadsafe(self.send, lines)
+                if not block:
+                    break
+        except OSError as error:
+            loop.call_soon_threadsafe(dump_to_stderr,
+                                      make_header() + f'cannot read {self.path}: {error}\n')
+        loop.call_soon_threadsafe(self.finish)
+
+    def send(self, lines: list[bytes]) -> None:
+        max_bytes = self.node.origin.max_text_bytes()
+        if not self.interrupted:
+            self.messages += self.node.send_batch(
+                line[i:i + max_bytes] for line in lines for i in range(0, len(line), max_bytes))
+        self.release()
+
+    def release(self) -> None:
+        if self.node.congested_neighbors and not self.interrupted:
+            self.node.loop.call_later(INGEST_POLL_SECONDS, self.release)
+        else:
+            self.slots.release()
+
+    def finish(self) -> None:
+        if not self.stopped.done():
+            self.stopped.set_result(True)
+
+    def stop(self) -> None:
+        self.interrupted = True
+        if not self.stopped.done():
+            self.stopped.set_result(False)
+
+    def report(self) -> None:
+        now = time.monotonic()
+        then, messages = self.reported
+        self.reported = (now, self.messages)
+        dump_to_stderr(make_header() + f'ingested {self.messages} messages '
+                       f'({(self.messages - messages) / (now - then):.1f} messages/s '
+                       f'in the last {now - then:.1f} seconds)\n')
+        self.reporter = self.node.loop.call_later(INGEST_REPORT_SECONDS, self.report)
+
+def gui_loop(name: str, my_address: tuple[str, int],
+             inviter_address: typing.Union[None, tuple[str, int]], limits: QueueLimits,
+             exporter: typing.Union[None, MetricsExporter],
+             links: list[tuple[str, int]], join_policy: JoinPolicy,
+             download_dir: typing.Union[None, str], log: typing.Union[None, MessageLog],
+             catch_up_seconds: typing.Union[None, float],
+             rate_limit: typing.Union[None, RateLimit], shards: typing.Union[None, Shards],
+             compression: bool) -> None:
     root = tkinter.Tk()
     root.title('p2p-tree-relay')
     root.resizable(False, False)
@@ -223,105 +2870,261 @@ def gui_loop(name: str, neighbors: list[Neighbor], lock: threading.Lock,
                                relief = 'ridge')
     entry_area.grid(row = 1, column = 0, sticky = 'NSEW')
 
-    def gui_output(message: str) -> None:
-        nonlocal display_area
-        display_area.insert(tkinter.INSERT, message)
+    renderer = Renderer()
+    output_queue = OutputQueue()
+
+    def gui_output() -> None:
+        '''
+        Displays the queued messages in one batch and reschedules itself.
+        '''
+        nonlocal root, display_area, renderer, output_queue
+        batch = output_queue.take()
+        if batch:
+            display_area.insert(tkinter.INSERT,
+                                ''.join([renderer.render(packet) for packet in batch]))
+        root.after(GUI_OUTPUT_INTERVAL_MILLISECONDS, gui_output)
+
+    root.after(GUI_OUTPUT_INTERVAL_MILLISECONDS, gui_output)
+    # start the node and run its event loop in another thread
+    node = Node(name, my_address, inviter_address, limits, output_queue.put,
+                links = links, join_policy = join_policy, download_dir = download_dir,
+                log = log, catch_up_seconds = catch_up_seconds, rate_limit = rate_limit,
+                shards = shards, compression = compression)
+    loop = asyncio.SelectorEventLoop(InstrumentedSelector(node.metrics.select_wait))
+    start_or_exit(loop, node, exporter)
+    event_loop_thread = threading.Thread(target = loop.run_forever)
+    event_loop_thread.start()
 
     def handle_input(event: tkinter.Event) -> None:
-        nonlocal name, neighbors, lock, display_area, entry_variable
+        nonlocal loop, node, entry_variable
         entry_text = entry_variable.get()
         entry_variable.set('')
-        message = make_header(name) + entry_text + '\n'
-        data = make_packet(message.encode())
-        with lock:
-            gui_output(message)
-            for neighbor in neighbors:
-                neighbor.write_buffer += data  # append data to all neighbor nodes' buffers
+        if entry_text.startswith(FILE_COMMAND):
+            loop.call_soon_threadsafe(node.send_file, entry_text[len(FILE_COMMAND):].strip())
+        else:
+            loop.call_soon_threadsafe(node.send, entry_text)
 
     entry_area.bind('<Key-Return>', handle_input)
-    # start the relayer
-    relayer_thread = threading.Thread(target = relayer, args = (lock, neighbors, gui_output))
-    relayer_thread.start()
 
     def exit_loop() -> None:
-        nonlocal lock, listener_thread, root, relayer_thread
-        stop_and_wait(lock, listener_thread, relayer_thread)
+        nonlocal loop, node, exporter, event_loop_thread, root
+        asyncio.run_coroutine_threadsafe(close_node(node, exporter), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        event_loop_thread.join()
+        loop.close()
         root.destroy()
 
     root.protocol('WM_DELETE_WINDOW', exit_loop)
     entry_area.focus_set()
     root.mainloop()
 
-def cli_loop(name: str, neighbors: list[Neighbor], lock: threading.Lock,
-             listener_thread: typing.Union[None, threading.Thread]) -> None:
+def cli_loop(name: str, my_address: tuple[str, int],
+             inviter_address: typing.Union[None, tuple[str, int]], limits: QueueLimits,
+             exporter: typing.Union[None, MetricsExporter],
+             links: list[tuple[str, int]], join_policy: JoinPolicy,
+             download_dir: typing.Union[None, str], log: typing.Union[None, MessageLog],
+             catch_up_seconds: typing.Union[None, float],
+             rate_limit: typing.Union[None, RateLimit], shards: typing.Union[None, Shards],
+             compression: bool) -> None:
 
-    def cli_output(message: str) -> None:
-        sys.stdout.write(message)
-        sys.stdout.flush()
+    output_queue = OutputQueue()
+    writer_thread = threading.Thread(target = cli_writer, args = (output_queue,))
+    writer_thread.start()
+    node = Node(name, my_address, inviter_address, limits, output_queue.put,
+                links = links, join_policy = join_policy, download_dir = download_dir,
+                log = log, catch_up_seconds = catch_up_seconds, rate_limit = rate_limit,
+                shards = shards, compression = compression)
+    loop = asyncio.SelectorEventLoop(InstrumentedSelector(node.metrics.select_wait))
+    try:
+        start_or_exit(loop, node, exporter)
+    except SystemExit:
+        output_queue.close()
+        raise
 
-    # start the relayer
-    relayer_thread = threading.Thread(target = relayer, args = (lock, neighbors, cli_output))
-    relayer_thread.start()
-    while True:
-        line = input()
-        if line == '':
-            stop_and_wait(lock, listener_thread, relayer_thread)
-            return
-        else:
-            message = make_header(name) + line + '\n'
-            data = make_packet(message.encode())
-            with lock:
-                cli_output(message)
-                for neighbor in neighbors:
-                    neighbor.write_buffer += data  # send data to all neighbor nodes
+    async def read_lines() -> None:
+        nonlocal loop, node, exporter
+        while True:
+            try:
+                line = await loop.run_in_executor(None, input)
+            except EOFError:
+                line = ''
+            if line == '':
+                await close_node(node, exporter)
+                return
+            elif line.startswith(FILE_COMMAND):
+                node.send_file(line[len(FILE_COMMAND):].strip())
+            else:
+                node.send(line)
 
-def start_node(name: str, my_address: tuple[str, int],
-               inviter_address: typing.Union[None, tuple[str, int]], option: str) -> None:
-    # prepare the neighbor list to be shared by all threads of this node
-    neighbors = []
-    # try to connect to the inviter
-    if inviter_address:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        client_socket.settimeout(SOCKET_CONNECTION_TIMEOUT_SECONDS)
+    loop.run_until_complete(read_lines())
+    loop.close()
+    output_queue.close()
+    writer_thread.join()
+    if output_queue.dropped_packets:
+        dump_to_stderr(make_header() +
+                       f'dropped {output_queue.dropped_packets} messages the output could not keep up with\n')
+
+def ingest_loop(name: str, my_address: tuple[str, int],
+                inviter_address: typing.Union[None, tuple[str, int]], limits: QueueLimits,
+                exporter: typing.Union[None, MetricsExporter],
+                links: list[tuple[str, int]], join_policy: JoinPolicy,
+                download_dir: typing.Union[None, str], log: typing.Union[None, MessageLog],
+                catch_up_seconds: typing.Union[None, float], rate_limit: typing.Union[None, RateLimit],
+                shards: typing.Union[None, Shards], compression: bool, input_path: str) -> None:
+    # a producer: nothing is displayed, the input is sent
+    node = Node(name, my_address, inviter_address, limits, lambda packet: None,
+                links = links, join_policy = join_policy, download_dir = download_dir,
+                log = log, catch_up_seconds = catch_up_seconds, rate_limit = rate_limit,
+                shards = shards, compression = compression)
+    loop = asyncio.SelectorEventLoop(InstrumentedSelector(node.metrics.select_wait))
+    start_or_exit(loop, node, exporter)
+    loop.run_until_complete(Ingest(node, input_path).run())
+    loop.run_until_complete(close_node(node, exporter))
+    loop.close()
+
+def start_or_exit(loop: asyncio.AbstractEventLoop, node: Node,
+                  exporter: typing.Union[None, MetricsExporter]) -> None:
+    try:
+        loop.run_until_complete(node.start())
+    except TimeoutError:
+        sys.exit(make_header() + f'connection to the inviter ({node.inviter_address}) timed out')
+    except OSError as error:
+        sys.exit(make_header() + f'cannot start the node: {error}')
+    if exporter is not None:
         try:
-            client_socket.connect(inviter_address)
-        except socket.timeout:
-            sys.exit(make_header() + f'connection to the inviter ({inviter_address}) timed out')
-        dump_to_stderr(make_header() + f'connected to the inviter ({inviter_address})\n')
-        client_socket.settimeout(SOCKET_OPERATION_TIMEOUT_SECONDS)
-        neighbors.append(Neighbor(client_socket, inviter_address, b'', b''))
-    # start the listener
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.settimeout(SOCKET_OPERATION_TIMEOUT_SECONDS)
-    server_socket.bind(my_address)
-    server_socket.listen()  # this does not need to block even if "setblocking(True)"
-    lock = threading.Lock()
-    listener_thread = threading.Thread(target = listener, args = (lock, server_socket, neighbors))
-    listener_thread.start()
+            loop.run_until_complete(exporter.start(node.metrics))
+        except (OSError, ValueError) as error:
+            loop.run_until_complete(node.close())
+            sys.exit(make_header() + f'cannot export the metrics: {error}')
+
+async def close_node(node: Node, exporter: typing.Union[None, MetricsExporter]) -> None:
+    if exporter is not None:
+        await exporter.close()
+    await node.close()
+
+def start_node(name: str, my_address: tuple[str, int],
+               inviter_address: typing.Union[None, tuple[str, int]], option: str,
+               limits: QueueLimits, exporter: typing.Union[None, MetricsExporter] = None,
+               links: typing.Iterable[tuple[str, int]] = (),
+               join_policy: typing.Union[None, JoinPolicy] = None,
+               download_dir: typing.Union[None, str] = None,
+               log: typing.Union[None, MessageLog] = None,
+               catch_up_seconds: typing.Union[None, float] = None,
+               rate_limit: typing.Union[None, RateLimit] = None,
+               input_path: str = '-', workers: int = 1, compression: bool = False) -> None:
+    shards = None
+    if workers > 1 and option in ('gui', 'cli', 'ingest'):
+        shards = Shards(workers)
+        shards.spawn(functools.partial(hub_worker, name, my_address, limits,
+                                       JoinPolicy() if join_policy is None else join_policy,
+                                       rate_limit))
     # start the main loop based on the option (GUI/CLI)
     if option == 'gui':
-        gui_loop(name, neighbors, lock, listener_thread)
+        gui_loop(name, my_address, inviter_address, limits, exporter, links, join_policy,
+                 download_dir, log, catch_up_seconds, rate_limit, shards, compression)
     elif option == 'cli':
-        cli_loop(name, neighbors, lock, listener_thread)
+        cli_loop(name, my_address, inviter_address, limits, exporter, links, join_policy,
+                 download_dir, log, catch_up_seconds, rate_limit, shards, compression)
+    elif option == 'ingest':
+        ingest_loop(name, my_address, inviter_address, limits, exporter, links, join_policy,
+                    download_dir, log, catch_up_seconds, rate_limit, shards, compression,
+                    input_path)
     else:
-        stop_and_wait(lock, listener_thread, None)
         sys.exit(make_header() + f'unknown or corrupted option "{option}"')
 
 if __name__ == '__main__':
-    if (len(sys.argv) != 5) and (len(sys.argv) != 7):
-        sys.exit(
-            f'python3 {sys.argv[0]} '
-            '<gui/cli> <name> <my-ip> <my-port> [inviter-ip] [inviter-port]'
-        )
+    parser = argparse.ArgumentParser(
+        usage = (f'python3 {sys.argv[0]} '
+                 '<gui/cli/ingest> <name> <my-ip> <my-port> [inviter-ip] [inviter-port] [options]'))
+    parser.add_argument('option')
+    parser.add_argument('name')
+    parser.add_argument('my_ip')
+    parser.add_argument('my_port', type = int)
+    parser.add_argument('inviter_ip', nargs = '?')
+    parser.add_argument('inviter_port', nargs = '?', type = int)
+    parser.add_argument('--queue-policy', choices = QUEUE_POLICIES, default = 'backpressure',
+                        help = 'what to do when a neighbor cannot keep up')
+    parser.add_argument('--high-watermark-bytes', type = int, default = 4 * 1024 * 1024)
+    parser.add_argument('--low-watermark-bytes', type = int, default = 2 * 1024 * 1024)
+    parser.add_argument('--high-watermark-packets', type = int, default = 32768)
+    parser.add_argument('--low-watermark-packets', type = int, default = 16384)
+    parser.add_argument('--link', action = 'append', default = [], metavar = 'IP:PORT',
+                        help = 'keep an extra link to another node of the tree (repeatable)')
+    parser.add_argument('--max-children', type = int, default = 8,
+                        help = 'redirect joining nodes to a child beyond this many children')
+    parser.add_argument('--max-depth', type = int, default = 16,
+                        help = 'redirect joining nodes to a shallower node beyond this depth')
+    parser.add_argument('--download-dir',
+                        help = 'save the files sent by others (with "/file <path>") here')
+    parser.add_argument('--log-dir', help = 'keep the relayed messages in a message log here')
+    parser.add_argument('--log-max-bytes', type = int, default = LOG_MAX_BYTES,
+                        help = 'delete the oldest log segments beyond this size')
+    parser.add_argument('--log-max-age', type = float, default = LOG_MAX_AGE_SECONDS,
+                        help = 'delete log segments whose messages are all older (seconds)')
+    parser.add_argument('--catch-up', type = float, metavar = 'SECONDS',
+                        help = 'after joining, ask for the messages of this many seconds before')
+    parser.add_argument('--rate-limit', type = float, metavar = 'BYTES',
+                        help = 'read at most this many bytes per second from each neighbor')
+    parser.add_argument('--rate-burst', type = float, metavar = 'BYTES',
+                        help = 'the most bytes read from a neighbor at once (default the rate)')
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = 'relay with this many processes sharing the port (a hub node)')
+    parser.add_argument('--compress', action = 'store_true',
+                        help = 'compress the texts of the messages this node sends')
+    parser.add_argument('--input', default = '-',
+                        help = 'the file or FIFO whose lines the ingest mode sends (default stdin)')
+    parser.add_argument('--metrics-address',
+                        help = 'serve metrics over HTTP on host:port or a UNIX socket path')
+    parser.add_argument('--metrics-json', help = 'append JSON metrics snapshots to this file')
+    parser.add_argument('--metrics-interval', type = float, default = 10,
+                        help = 'seconds between JSON metrics snapshots')
+    args = parser.parse_args()
+    if (args.inviter_ip is None) != (args.inviter_port is None):
+        parser.error('the inviter needs both an ip and a port')
     # TODO: add some argument checks
-    option = sys.argv[1]
-    name = sys.argv[2]
-    my_address = (sys.argv[3], int(sys.argv[4]))
-    inviter_address = None if len(sys.argv) == 5 else (sys.argv[5], int(sys.argv[6]))
+    option = args.option
+    name = args.name
+    my_address = (args.my_ip, args.my_port)
+    inviter_address = None if args.inviter_ip is None else (args.inviter_ip, args.inviter_port)
+    limits = QueueLimits(args.high_watermark_bytes, args.low_watermark_bytes,
+                         args.high_watermark_packets, args.low_watermark_packets,
+                         args.queue_policy)
+    links = []
+    for link in args.link:
+        link_ip, _, link_port = link.rpartition(':')
+        if not link_ip or not link_port.isdigit():
+            parser.error(f'bad link "{link}" (expected IP:PORT)')
+        links.append((link_ip, int(link_port)))
+    exporter = None
+    if args.metrics_address is not None or args.metrics_json is not None:
+        exporter = MetricsExporter(args.metrics_address, args.metrics_json, args.metrics_interval)
     try:
-        start_node(name, my_address, inviter_address, option)
-    except:  # when one thread throws exceptions, let all other threads terminate through HALTED
-        with lock:
-            HALTED = True
+        join_policy = JoinPolicy(args.max_children, args.max_depth)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.download_dir is not None and not os.path.isdir(args.download_dir):
+        parser.error(f'"{args.download_dir}" is not a directory')
+    if args.workers < 1:
+        parser.error('a node needs at least 1 worker')
+    if args.workers > 1 and not (hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork')):
+        parser.error('more than 1 worker needs SO_REUSEPORT and fork')
+    if args.workers > 1 and args.log_dir is not None:
+        # only worker 0 keeps the log, so the children of the others could not catch up
+        parser.error('a message log cannot be kept by more than 1 worker')
+    rate_limit = None
+    if args.rate_limit is not None:
+        try:
+            rate_limit = RateLimit(args.rate_limit, args.rate_burst)
+        except ValueError as error:
+            parser.error(str(error))
+    log = None
+    if args.log_dir is not None:
+        try:
+            os.makedirs(args.log_dir, exist_ok = True)
+            log = MessageLog(args.log_dir, max_bytes = args.log_max_bytes,
+                             max_age_seconds = args.log_max_age)
+        except OSError as error:
+            sys.exit(make_header() + f'cannot open the message log: {error}')
+    start_node(name, my_address, inviter_address, option, limits, exporter, links, join_policy,
+               args.download_dir, log, args.catch_up, rate_limit, args.input, args.workers,
+               args.compress)
@@ -0,0 +1,278 @@
+'''
+A simulator of large trees in one process.
+All nodes share one event loop and a MemoryTransport (no ports are used).
+It builds a topology (a tree, optionally with extra links between random nodes),
+injects messages, fails nodes, lets the orphaned subtrees reconnect and then checks delivery:
+every live node must receive every message sent in its part of the network
+exactly once and in the order of each sender.
+Topologies, senders and failures come from a seeded random generator,
+and the checks do not depend on timing, so runs are reproducible.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import time
+import typing
+
+import bench
+import node
+
+SHAPES = bench.SHAPES + ('random',)
+POLL_SECONDS = 0.01
+JOIN_POLL_SECONDS = 0.0005
+TIMEOUT_SECONDS = 60
+FILES_PER_NODE = 4  # a listener (a socketpair) and the ends of its connections
+
+def make_parents(shape: str, nodes: int, fanout: int, rng: random.Random) -> list[int]:
+    if shape == 'random':
+        return [None] + [rng.randrange(i) for i in range(1, nodes)]
+    return bench.make_parents(shape, nodes, fanout)
+
+def raise_file_limit(nodes: int) -> None:
+    '''
+    Every connection takes two file descriptors in this process.
+    '''
+    needed = FILES_PER_NODE * nodes + 64
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY and hard < needed:
+            raise OSError(f'{nodes} nodes need {needed} file descriptors (the limit is {hard})')
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+class Recorder:
+    '''
+    The messages a node displayed, as (sender index, message number) in arrival order.
+    Simulated messages are "sim <sender index> <message number>".
+    '''
+    def __init__(self):
+        self.received = []
+
+    def on_message(self, packet: node.Packet) -> None:
+        payload = packet.payload()
+        name_length = payload[node.MESSAGE_HEADER.size - 1]
+        _, sender, number = bytes(payload[node.MESSAGE_HEADER.size + name_length:]).split()
+        self.received.append((int(sender), int(number)))
+
+def components(adjacency: list[list[int]], alive: set[int]) -> dict[int, int]:
+    '''
+    The part of the network (named by its lowest node) each live node is in.
+    '''
+    tops = {}
+    for i in sorted(alive):
+        if i in tops:
+            continue
+        tops[i] = i
+        frontier = [i]
+        while frontier:
+            u = frontier.pop()
+            for v in adjacency[u]:
+                if v in alive and v not in tops:
+                    tops[v] = i
+                    frontier.append(v)
+    return tops
+
+async def wait_until(condition, timeout: float = TIMEOUT_SECONDS,
+                     poll_seconds: float = POLL_SECONDS) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(poll_seconds)
+    return True
+
+class Simulation:
+    def __init__(self, shape: str, nodes: int, fanout: int, seed: int, extra_links: int,
+                 join_policy: typing.Union[None, node.JoinPolicy]):
+        self.rng = random.Random(seed)
+        self.parents = make_parents(shape, nodes, fanout, self.rng)
+        self.links = [[] for _ in range(nodes)]  # node -> the earlier nodes it links to
+        self.adjacency = [[] for _ in range(nodes)]
+        for child, parent in enumerate(self.parents):
+            if parent is not None:
+                self.adjacency[child].append(parent)
+                self.adjacency[parent].append(child)
+        for _ in range(extra_links if nodes > 2 else 0):
+            i, j = sorted(self.rng.sample(range(nodes), 2))
+            if j not in self.adjacency[i]:
+                self.links[j].append(i)
+                self.adjacency[i].append(j)
+                self.adjacency[j].append(i)
+        self.transport = node.MemoryTransport()
+        self.recorders = [Recorder() for _ in range(nodes)]
+        self.nodes = []
+        self.alive = set()
+        self.message_counter = 0
+        self.join_policy = join_policy
+        # without a policy, joins are never redirected, so the tree has the generated shape
+        self.node_join_policy = node.JoinPolicy(nodes, nodes) if join_policy is None else join_policy
+
+    async def build(self) -> None:
+        for i, parent in enumerate(self.parents):  # a parent listens before its children join
+            the_node = node.Node(f'n{i}', ('sim', i),
+                                 None if parent is None else ('sim', parent),
+                                 on_message = self.recorders[i].on_message,
+                                 transport = self.transport,
+                                 links = [('sim', j) for j in self.links[i]],
+                                 join_policy = self.node_join_policy)
+            await the_node.start()
+            self.nodes.append(the_node)
+            self.alive.add(i)
+            if self.join_policy is not None and parent is not None:
+                # one join at a time, as the redirects depend on the joins before
+                await wait_until(lambda: the_node.depth > 0, poll_seconds = JOIN_POLL_SECONDS)
+        await wait_until(self.settled)
+        self.update_adjacency()
+
+    def settled(self) -> bool:
+        '''
+        Whether no node is reconnecting and every link is between live nodes that know
+        each other's addresses.
+        '''
+        for i in self.alive:
+            the_node = self.nodes[i]
+            if the_node.repair_task is not None and not the_node.repair_task.done():
+                return False
+            for neighbor in the_node.neighbors:
+                if (neighbor.protocol is None or neighbor.listen_address is None or
+                    neighbor.listen_address[1] not in self.alive):
+                    return False
+        return True
+
+    def update_adjacency(self) -> None:
+        '''
+        Reads the links the nodes actually have (after the repairs).
+        '''
+        self.adjacency = [[] for _ in self.nodes]
+        for i in self.alive:
+            for neighbor in self.nodes[i].neighbors:
+                self.adjacency[i].append(neighbor.listen_address[1])
+
+    async def fail(self, count: int) -> list[int]:
+        '''
+        Closes "count" random nodes (never the root) and waits until the tree is repaired.
+        '''
+        failed = self.rng.sample(sorted(self.alive - {0}), min(count, len(self.alive) - 1))
+        for i in failed:
+            await self.nodes[i].close()
+            self.alive.discard(i)
+        await asyncio.sleep(POLL_SECONDS)  # lets the neighbors notice
+        await wait_until(self.settled)
+        self.update_adjacency()
+        return failed
+
+    async def inject(self, messages: int) -> dict:
+        '''
+        Sends messages from random live nodes and checks where they arrive.
+        '''
+        for recorder in self.recorders:
+            recorder.received.clear()
+        tops = components(self.adjacency, self.alive)
+        alive = sorted(self.alive)
+        duplicates = sum(self.nodes[i].duplicate_counter for i in alive)
+        sent = {}  # top -> messages sent in that part of the network
+        start = time.monotonic()
+        for _ in range(messages):
+            sender = self.rng.choice(alive)
+            self.message_counter += 1
+            self.nodes[sender].send(f'sim {sender} {self.message_counter}')
+            sent.setdefault(tops[sender], []).append((sender, self.message_counter))
+        expected = {i: len(sent.get(tops[i], ())) for i in alive}
+        complete = await wait_until(lambda: all(len(self.recorders[i].received) >= expected[i]
+                                                for i in alive))
+        seconds = time.monotonic() - start
+        failures = 0
+        for i in alive:
+            received = self.recorders[i].received
+            expected_set = set(sent.get(tops[i], ()))
+            if len(received) != len(expected_set) or set(received) != expected_set:
+                failures += 1
+                continue
+            last = {}
+            for sender, number in received:
+                if number < last.get(sender, 0):
+                    failures += 1
+                    break
+                last[sender] = number
+        deliveries = sum(expected.values())
+        return {'messages': messages,
+                'duplicates_dropped': sum(self.nodes[i].duplicate_counter for i in alive) - duplicates,
+                'live_nodes': len(alive),
+                'parts': len(set(tops.values())),
+                'deliveries': deliveries,
+                'seconds': round(seconds, 4),
+                'deliveries_per_second': round(deliveries / max(seconds, 1e-9), 1),
+                'complete': complete,
+                'nodes_with_wrong_delivery': failures,
+                'ok': complete and failures == 0}
+
+    async def close(self) -> None:
+        for i in sorted(self.alive):
+            await self.nodes[i].close()
+
+async def simulate(shape: str = 'random', nodes: int = 1000, fanout: int = 2, seed: int = 0,
+                   messages: int = 100, failures: int = 10, extra_links: int = 0,
+                   join_policy: typing.Union[None, node.JoinPolicy] = None) -> dict:
+    '''
+    Builds the network, injects messages, fails nodes and injects messages again.
+    '''
+    raise_file_limit(nodes + extra_links)
+    simulation = Simulation(shape, nodes, fanout, seed, extra_links, join_policy)
+    start = time.monotonic()
+    try:
+        await simulation.build()
+        built = time.monotonic()
+        depth = max(the_node.depth for the_node in simulation.nodes)
+        phases = [await simulation.inject(messages)]
+        failed = await simulation.fail(failures)
+        phases.append(await simulation.inject(messages))
+        phases[-1]['failed_nodes'] = failed
+        repaired = [the_node for the_node in simulation.nodes if the_node.repair_counter]
+        phases[-1]['repairs'] = sum(the_node.repair_counter for the_node in repaired)
+        phases[-1]['slowest_repair_seconds'] = round(max(
+            [the_node.last_repair_seconds for the_node in repaired], default = 0), 4)
+    finally:
+        await simulation.close()
+    return {'shape': shape,
+            'nodes': nodes,
+            'seed': seed,
+            'extra_links': sum(len(links) for links in simulation.links),
+            'build_seconds': round(built - start, 4),
+            'depth': depth,
+            'phases': phases,
+            'ok': all(phase['ok'] for phase in phases)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--shape', choices = SHAPES, default = 'random')
+    parser.add_argument('--nodes', type = int, default = 1000)
+    parser.add_argument('--fanout', type = int, default = 2,
+                        help = 'the number of children per node of a balanced tree')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--messages', type = int, default = 100,
+                        help = 'messages injected before and after the failures')
+    parser.add_argument('--failures', type = int, default = 10, help = 'nodes to fail')
+    parser.add_argument('--extra-links', type = int, default = 0,
+                        help = 'links to add between random nodes besides the tree')
+    parser.add_argument('--max-children', type = int,
+                        help = 'balance the joins with this many children per node at most')
+    parser.add_argument('--max-depth', type = int, default = 16,
+                        help = 'the most depth allowed when balancing the joins')
+    arguments = parser.parse_args()
+    join_policy = None  # no redirects, so the shapes are the generated ones
+    if arguments.max_children is not None:
+        join_policy = node.JoinPolicy(arguments.max_children, arguments.max_depth)
+    sys.stderr = open(os.devnull, 'w')  # the nodes' system messages
+    try:
+        results = asyncio.run(simulate(arguments.shape, arguments.nodes, arguments.fanout,
+                                       arguments.seed, arguments.messages, arguments.failures,
+                                       arguments.extra_links, join_policy))
+    except OSError as error:
+        sys.stderr = sys.__stderr__
+        sys.exit(f'cannot simulate: {error}')
+    sys.stdout.write(json.dumps(results, indent = 2) + '\n')
+    sys.exit(0 if results['ok'] else 1)
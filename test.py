@@ -1,6 +1,20 @@
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import os
+import selectors
+import socket
 import sys
 import subprocess
+import tempfile
 import time
+import typing
+import zlib
+
+import node
+import sim
 
 SUBPROCESS_LIST = []
 
@@ -46,9 +60,24 @@ def verify_termination(p: subprocess.Popen) -> None:
         p.kill()
         raise P2PTreeTestError()
 
+def verify_packet(packet: node.Packet, s: str) -> None:
+    print('.', end = '', flush = True)
+    if s not in node.Renderer().render(packet):
+        raise P2PTreeTestError()
+
 def nap() -> None:
     time.sleep(1)
 
+async def wait_until(condition: typing.Callable[[], bool], timeout: float = 10) -> None:
+    '''
+    Polls "condition" from a running event loop; the test fails after "timeout" seconds.
+    '''
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise P2PTreeTestError()
+        await asyncio.sleep(0.001)
+
 def p2p_tree_test_1() -> None:
     try:
         a = launch(['A', 'localhost', '10001'])
@@ -216,10 +245,17 @@ def p2p_tree_test_5() -> None:
         verify_err_line(d, 'detected')
         nap()
         verify_termination(c)
+        # D repairs the tree by reconnecting to its grandparent B
+        verify_err_line(d, 'reconnected')
+        verify_err_line(b, 'accepted')
         write_line(a, 'This is A again')
         verify_out_line(a, 'This is A again')
         verify_out_line(b, 'This is A again')
+        verify_out_line(d, 'This is A again')
+        verify_out_line(e, 'This is A again')
         write_line(e, 'This is E again')
+        verify_out_line(a, 'This is E again')
+        verify_out_line(b, 'This is E again')
         verify_out_line(d, 'This is E again')
         verify_out_line(e, 'This is E again')
         write_line(a, '')
@@ -227,6 +263,7 @@ def p2p_tree_test_5() -> None:
         nap()
         verify_termination(a)
         write_line(b, '')
+        verify_err_line(d, 'detected')
         nap()
         verify_termination(b)
         write_line(e, '')
@@ -240,6 +277,726 @@ def p2p_tree_test_5() -> None:
         clean()
         raise
 
+def p2p_tree_test_6() -> None:
+    try:
+        long_line = 'This is a long line from A ' + 'x' * 300
+        a = launch(['A', 'localhost', '10001'])
+        nap()
+        b = launch(['B', 'localhost', '10002', 'localhost', '10001'])
+        nap()
+        verify_err_line(a, 'accepted')
+        verify_err_line(b, 'connected')
+        c = launch(['C', 'localhost', '10003', 'localhost', '10002'])
+        nap()
+        verify_err_line(b, 'accepted')
+        verify_err_line(c, 'connected')
+        write_line(a, long_line)
+        verify_out_line(a, long_line)
+        verify_out_line(b, long_line)
+        verify_out_line(c, long_line)
+        write_line(a, '')
+        write_line(b, '')
+        write_line(c, '')
+        nap()
+        verify_termination(a)
+        verify_termination(b)
+        verify_termination(c)
+    except P2PTreeTestError:
+        clean()
+        raise
+
+def p2p_tree_test_7() -> None:
+    # nodes embedded in one process through the Node API
+
+    async def scenario() -> None:
+        a = node.Node('A', ('localhost', 10001))
+        await a.start()
+        b = node.Node('B', ('localhost', 10002), ('localhost', 10001))
+        await b.start()
+        c = node.Node('C', ('localhost', 10003), ('localhost', 10002))
+        await c.start()
+        await asyncio.sleep(0.5)
+        c.send('This is C')
+        for n in (a, b, c):
+            verify_packet(await asyncio.wait_for(anext(n), 5), 'This is C')
+        a.send('This is A')
+        for n in (a, b, c):
+            verify_packet(await asyncio.wait_for(anext(n), 5), 'This is A')
+        for n in (a, b, c):
+            await n.close()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(scenario())
+
+def p2p_tree_test_8() -> None:
+    # the output queue hands over messages in order and in batches,
+    # dropping the oldest ones when the writer falls behind
+    origin = node.Origin('A')
+    output_queue = node.OutputQueue(3)
+    for i in range(5):
+        output_queue.put(origin.make_message(f'line {i}'))
+    if not output_queue.ready.is_set():
+        raise P2PTreeTestError()
+    batch = output_queue.take()
+    if output_queue.ready.is_set() or output_queue.dropped_packets != 2:
+        raise P2PTreeTestError()
+    for packet, i in zip(batch, range(2, 5), strict = True):
+        verify_packet(packet, f'line {i}')
+    if output_queue.take():
+        raise P2PTreeTestError()
+
+def p2p_tree_test_9() -> None:
+    # metrics of the relay phases and buffers served in the Prometheus text format
+
+    async def scenario() -> None:
+        a = node.Node('A', ('localhost', 10001))
+        await a.start()
+        exporter = node.MetricsExporter('localhost:10006')
+        await exporter.start(a.metrics)
+        b = node.Node('B', ('localhost', 10002), ('localhost', 10001))
+        await b.start()
+        await asyncio.sleep(0.5)
+        b.send('This is B')
+        verify_packet(await asyncio.wait_for(anext(a), 5), 'This is B')
+        reader, writer = await asyncio.open_connection('localhost', 10006)
+        writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = (await reader.read()).decode()
+        writer.close()
+        for line in ('HTTP/1.0 200 OK', 'p2p_tree_messages_total 1', 'p2p_tree_neighbors 1',
+                     'p2p_tree_phase_seconds_count{phase="recv"}',
+                     'p2p_tree_neighbor_buffered_bytes{neighbor="127.0.0.1:'):
+            print('.', end = '', flush = True)
+            if line not in response:
+                raise P2PTreeTestError()
+        await exporter.close()
+        for n in (a, b):
+            await n.close()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(scenario())
+
+def p2p_tree_test_10() -> None:
+    # a simulated tree of in-memory nodes (with some extra links)
+    # delivers every message exactly once, before and after some nodes fail
+    with contextlib.redirect_stderr(io.StringIO()):
+        results = asyncio.run(sim.simulate('random', 300, seed = 1, messages = 30, failures = 5,
+                                           extra_links = 30))
+    for phase in results['phases']:
+        print('.', end = '', flush = True)
+        if not phase['ok']:
+            raise P2PTreeTestError()
+
+def p2p_tree_test_11() -> None:
+    # message ids are remembered for a bounded time and in a bounded number
+    seen = node.SeenMessages(capacity = 3, window_seconds = 10)
+    for message_id, now, new in ((b'a', 0, True), (b'a', 1, False), (b'b', 2, True),
+                                 (b'c', 3, True), (b'd', 4, True), (b'a', 5, True),
+                                 (b'e', 16, True), (b'c', 16, True)):
+        print('.', end = '', flush = True)
+        if seen.add(message_id, now) != new or len(seen) > 3:
+            raise P2PTreeTestError()
+
+def p2p_tree_test_12() -> None:
+    # nodes invited by one node are redirected down the tree, which stays shallow
+    with contextlib.redirect_stderr(io.StringIO()):
+        results = asyncio.run(sim.simulate('star', 100, seed = 2, messages = 20, failures = 5,
+                                           join_policy = node.JoinPolicy(max_children = 3)))
+    print('.', end = '', flush = True)
+    if results['depth'] > 5:
+        raise P2PTreeTestError()
+    for phase in results['phases']:
+        print('.', end = '', flush = True)
+        if not phase['ok']:
+            raise P2PTreeTestError()
+
+    async def chain() -> int:
+        # each node joins the last one at once, before that one knows its own depth
+        transport = node.MemoryTransport()
+        nodes = []
+        for i in range(30):
+            the_node = node.Node(f'n{i}', ('test', i), None if i == 0 else ('test', i - 1),
+                                 on_message = lambda packet: None, transport = transport,
+                                 join_policy = node.JoinPolicy(max_depth = 8))
+            await the_node.start()
+            nodes.append(the_node)
+        await wait_until(lambda: all(the_node.depth for the_node in nodes[1:]))
+        depth = max(the_node.depth for the_node in nodes)
+        for the_node in nodes:
+            await the_node.close()
+        return depth
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        depth = asyncio.run(chain())
+    print('.', end = '', flush = True)
+    if depth > 8:
+        raise P2PTreeTestError()
+
+def p2p_tree_test_13() -> None:
+    # a file is streamed through the tree and saved whole,
+    # while a message sent during the transfer overtakes it
+
+    async def scenario(directory: str) -> None:
+        data = os.urandom(4 * 1024 * 1024 + 1000)
+        path = os.path.join(directory, 'data.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        transport = node.MemoryTransport()
+        received = {name: [] for name in 'ABC'}
+        nodes = []
+        for i, name in enumerate('ABC'):
+            download_dir = os.path.join(directory, name)
+            os.mkdir(download_dir)
+            n = node.Node(name, ('test', i), ('test', i - 1) if i else None,
+                          on_message = received[name].append, transport = transport,
+                          download_dir = download_dir)
+            await n.start()
+            nodes.append(n)
+        a, b, c = nodes
+        await wait_until(lambda: c.depth == 2)
+        a.send_file(path)
+        await wait_until(lambda: any(download.next_index for download in c.downloads.values()))
+        a.send('This is A')
+        await wait_until(lambda: len(received['C']) == 2)
+        verify_packet(received['C'][1], 'This is A')
+        print('.', end = '', flush = True)
+        if not c.downloads:  # the message must not wait for the whole file
+            raise P2PTreeTestError()
+        for name in 'BC':
+            saved = os.path.join(directory, name, 'data.bin')
+            await wait_until(lambda: os.path.exists(saved))
+            print('.', end = '', flush = True)
+            with open(saved, 'rb') as f:
+                if f.read() != data:
+                    raise P2PTreeTestError()
+            if not received[name][0].payload().tobytes().endswith(
+                    f'sent the file "data.bin" ({len(data)} bytes)'.encode()):
+                raise P2PTreeTestError()
+        if os.listdir(os.path.join(directory, 'A')):
+            raise P2PTreeTestError()
+        for n in nodes:
+            await n.close()
+
+    async def stalled(directory: str) -> None:
+        # a download that stops before its END is given up, after a while or with its link
+        transport = node.MemoryTransport()
+        a = node.Node('A', ('test', 0), on_message = lambda packet: None, transport = transport)
+        await a.start()
+        b = node.Node('B', ('test', 1), ('test', 0), on_message = lambda packet: None,
+                      transport = transport, download_dir = directory)
+        await b.start()
+        await wait_until(lambda: b.depth == 1)
+        for number, file_name in enumerate(('idle.bin', 'orphan.bin')):
+            a.relay_transfer(number, 0, node.TRANSFER_BEGIN, json.dumps(
+                {'name': 'A', 'file': file_name, 'size': 2 * node.TRANSFER_CHUNK_BYTES,
+                 'chunk_bytes': node.TRANSFER_CHUNK_BYTES}).encode())
+            a.relay_transfer(number, 0, node.TRANSFER_CHUNK, b'x' * node.TRANSFER_CHUNK_BYTES)
+        await wait_until(lambda: len(b.downloads) == 2 and all(
+            download.next_index == 1 for download in b.downloads.values()))
+        print('.', end = '', flush = True)
+        if sorted(os.listdir(directory)) != ['idle.bin.part', 'orphan.bin.part']:
+            raise P2PTreeTestError()
+        b.downloads[(a.origin.sender_id, 0)].active -= node.TRANSFER_IDLE_SECONDS
+        b.check_downloads()
+        print('.', end = '', flush = True)
+        if os.listdir(directory) != ['orphan.bin.part'] or b.downloads_timer is None:
+            raise P2PTreeTestError()
+        await a.close()
+        await wait_until(lambda: not b.downloads)
+        print('.', end = '', flush = True)
+        if os.listdir(directory):
+            raise P2PTreeTestError()
+        await b.close()
+
+    with contextlib.redirect_stderr(io.StringIO()), tempfile.TemporaryDirectory() as directory:
+        asyncio.run(scenario(directory))
+    with contextlib.redirect_stderr(io.StringIO()), tempfile.TemporaryDirectory() as directory:
+        asyncio.run(stalled(directory))
+
+def p2p_tree_test_14() -> None:
+    # the message log keeps its newest segments, survives reopening,
+    # and replays the messages a joining node asks for
+
+    def logged(log: node.MessageLog, start: int) -> bytes:
+        return b''.join(view.tobytes() for view in log.slices(start, log.next_sequence()))
+
+    async def scenario(directory: str) -> None:
+        transport = node.MemoryTransport()
+        received = {name: [] for name in 'ABC'}
+        nodes = []
+        for i, name in enumerate('ABC'):
+            log_dir = os.path.join(directory, name)
+            os.mkdir(log_dir)
+            n = node.Node(name, ('test', i), ('test', i - 1) if i else None,
+                          on_message = received[name].append, transport = transport,
+                          log = node.MessageLog(log_dir), catch_up_seconds = 60)
+            await n.start()
+            nodes.append(n)
+            if i == 0:
+                continue
+            await wait_until(lambda: n.depth == i)
+            for j in range(3):
+                nodes[0].send(f'message {i} {j}')
+            await wait_until(lambda: len(received[name]) == 3 * i)
+            for j, packet in enumerate(received[name]):
+                verify_packet(packet, f'message {(j // 3) + 1} {j % 3}')
+        for n in nodes:
+            await n.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        origin = node.Origin('A')
+        frames = [origin.make_message(f'message {i} ' + 'x' * 100).frame for i in range(100)]
+        log = node.MessageLog(directory, segment_bytes = 4096, max_bytes = 3 * 4096,
+                              max_age_seconds = 1000)
+        for i, frame in enumerate(frames):
+            log.append(frame, 1000 * i)
+        print('.', end = '', flush = True)
+        if len(os.listdir(directory)) != 3 or log.size() != 3 * 4096:
+            raise P2PTreeTestError()
+        start = log.first_sequence()
+        if logged(log, start) != b''.join(frames[start:]):
+            raise P2PTreeTestError()
+        print('.', end = '', flush = True)
+        if log.sequence_at(95500) != 96 or logged(log, 96) != b''.join(frames[96:]):
+            raise P2PTreeTestError()
+        log.close()
+        log = node.MessageLog(directory, segment_bytes = 4096, max_bytes = 3 * 4096)
+        print('.', end = '', flush = True)
+        if log.first_sequence() != start or logged(log, start) != b''.join(frames[start:]):
+            raise P2PTreeTestError()
+        log.max_age_seconds = 0
+        log.retain(time.time_ns() // 1000000 + 1000)  # all but the last segment expire
+        print('.', end = '', flush = True)
+        if len(os.listdir(directory)) != 1 or log.next_sequence() != 100:
+            raise P2PTreeTestError()
+        log.close()
+    with tempfile.TemporaryDirectory() as directory:  # messages logged during a replay
+        log = node.MessageLog(directory, segment_bytes = 4096, max_bytes = 2 * 4096,
+                              max_age_seconds = 1000)
+        for i, frame in enumerate(frames[:50]):
+            log.append(frame, 1000 * i)
+        start = log.first_sequence()
+        replay = log.slices(start, log.next_sequence(), 1024)
+        replayed = [next(replay).tobytes()]
+        for i, frame in enumerate(frames):  # the segments being replayed expire
+            log.append(frame, 1000 * (50 + i))
+        replayed += [view.tobytes() for view in replay]
+        print('.', end = '', flush = True)
+        if b''.join(replayed) != b''.join(frames[start:50]) or len(os.listdir(directory)) != 2:
+            raise P2PTreeTestError()
+        log.close()
+    with contextlib.redirect_stderr(io.StringIO()), tempfile.TemporaryDirectory() as directory:
+        asyncio.run(scenario(directory))
+
+def p2p_tree_test_15() -> None:
+    # the ingest mode sends every line of a file in order, skipping empty lines
+    # and splitting lines too long for a frame
+
+    async def scenario(path: str, lines: list[bytes]) -> None:
+        transport = node.MemoryTransport()
+        received = []
+        a = node.Node('A', ('test', 0), on_message = lambda packet: None, transport = transport)
+        await a.start()
+        b = node.Node('B', ('test', 1), ('test', 0), on_message = received.append,
+                      transport = transport)
+        await b.start()
+        ingest = node.Ingest(a, path)
+        await ingest.run()
+        await wait_until(lambda: len(received) >= len(lines))
+        print('.', end = '', flush = True)
+        if ingest.messages != len(lines) or len(received) != len(lines):
+            raise P2PTreeTestError()
+        for packet, line in zip(received, lines):
+            if not packet.payload().tobytes().endswith(b'A' + line):  # the name, then the text
+                raise P2PTreeTestError()
+        print('.', end = '', flush = True)
+        for n in (a, b):
+            await n.close()
+
+    max_bytes = node.Origin('A').max_text_bytes()
+    lines = [f'line {i}'.encode() for i in range(20000)]
+    with contextlib.redirect_stderr(io.StringIO()), tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'input')
+        with open(path, 'wb') as f:
+            f.write(b'\n'.join(lines[:10000]) + b'\n\n' + b'y' * (max_bytes + 10) + b'\n' +
+                    b'\n'.join(lines[10000:]))
+        lines[10000:10000] = [b'y' * max_bytes, b'y' * 10]
+        asyncio.run(scenario(path, lines))
+
+def p2p_tree_test_16() -> None:
+    # a flooding sender does not hold up another sender's message or a control frame
+    # for long, and a rate-limited node reads no faster than its limit
+    flooder = node.Origin('F')
+    sender = node.Origin('S')
+    sockets = socket.socketpair()
+    neighbor = node.Neighbor(sockets[0], ('test', 0), node.QueueLimits())
+    neighbor.negotiated(node.PROTOCOL_FRAMED)
+    flood = [flooder.make_message(f'flood {i} ' + 'x' * 100) for i in range(2000)]
+    for packet in flood:
+        neighbor.enqueue(packet)
+    message = sender.make_message('hello')
+    neighbor.enqueue(message)
+    control = node.make_control(node.CONTROL_SUBTREE, {'size': 1, 'height': 0})
+    neighbor.enqueue(control)
+    order = []
+    while neighbor.write_buffer:
+        order.append(neighbor.write_buffer.chunks[0])
+        neighbor.write_buffer.consume(len(order[-1]))
+        neighbor.refill()
+    for s in sockets:
+        s.close()
+    print('.', end = '', flush = True)
+    if [frame for frame in order if frame in (message.frame, control.frame)] != [
+            control.frame, message.frame]:
+        raise P2PTreeTestError()
+    print('.', end = '', flush = True)
+    limit = (node.REFILL_BYTES + node.DRR_QUANTUM_BYTES) // len(flood[0].frame) + 2
+    if order.index(message.frame) > limit or order.index(control.frame) > limit:
+        raise P2PTreeTestError()
+    print('.', end = '', flush = True)
+    if [frame for frame in order if frame not in (message.frame, control.frame)] != [
+            packet.frame for packet in flood]:
+        raise P2PTreeTestError()
+    sockets = socket.socketpair()  # the "drop-oldest" policy drops messages, never controls
+    neighbor = node.Neighbor(sockets[0], ('test', 0), node.QueueLimits(
+        high_packets = 2, low_packets = 1, policy = 'drop-oldest'), initiator = True,
+        local_address = ('test', 1))
+    neighbor.negotiated(node.PROTOCOL_FRAMED)
+    neighbor.enqueue(control)
+    for packet in flood[:3]:
+        neighbor.enqueue(packet)
+    for s in sockets:
+        s.close()
+    chunks = list(neighbor.write_buffer.chunks)
+    print('.', end = '', flush = True)
+    if (len(chunks) != 2 or not chunks[0].startswith(node.HANDSHAKE_HELLO) or
+        chunks[1] != control.frame or neighbor.dropped_packets != 3):
+        raise P2PTreeTestError()
+    sockets = socket.socketpair()  # nor does the "drop-newest" policy
+    neighbor = node.Neighbor(sockets[0], ('test', 0), node.QueueLimits(
+        high_packets = 2, low_packets = 1, policy = 'drop-newest'))
+    neighbor.negotiated(node.PROTOCOL_FRAMED)
+    for packet in flood[:3]:
+        neighbor.enqueue(packet)
+    neighbor.enqueue(control)
+    for s in sockets:
+        s.close()
+    chunks = list(neighbor.write_buffer.chunks)
+    print('.', end = '', flush = True)
+    if (chunks != [flood[0].frame, flood[1].frame, control.frame] or
+        neighbor.dropped_packets != 1):
+        raise P2PTreeTestError()
+
+    async def scenario() -> None:
+        transport = node.MemoryTransport()
+        received = []
+        a = node.Node('A', ('test', 0), on_message = lambda packet: None, transport = transport)
+        await a.start()
+        b = node.Node('B', ('test', 1), ('test', 0), on_message = received.append,
+                      transport = transport, rate_limit = node.RateLimit(1000000, 100000))
+        await b.start()
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        a.send_batch('x' * 1000 for _ in range(500))
+        await wait_until(lambda: len(received) >= 500)
+        seconds = time.monotonic() - start
+        print('.', end = '', flush = True)
+        if len(received) != 500 or seconds < 0.35:
+            raise P2PTreeTestError()
+        for n in (a, b):
+            await n.close()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(scenario())
+
+def p2p_tree_test_17() -> None:
+    # a hub node with two worker processes relays between the neighbors of both
+    # and counts the children of both in its subtree
+    ring = node.ShardRing(2, 64)
+    for i in range(100):  # wraps around the ring many times
+        frame = bytes([i]) * (i % 20)
+        if not ring.write(frame, [1]) or ring.read(1) != [frame]:
+            raise P2PTreeTestError()
+    written = 0
+    while ring.write(b'x' * 10, [1]):  # until the reader is a whole ring behind
+        written += 1
+    print('.', end = '', flush = True)
+    if written < 3 or ring.read(1) != [b'x' * 10] * written or not ring.write(b'x' * 10, [1]):
+        raise P2PTreeTestError()
+
+    async def backlog() -> None:
+        # while its ring is full, a worker stops reading and drops only its oldest messages
+        shards = node.Shards(2, 64 * 1024)
+        hub = node.Node('H', ('test', 0), on_message = lambda packet: None,
+                        transport = node.MemoryTransport(), shards = shards)
+        await hub.start()
+        hub.send_batch('x' for _ in range(64 * 1024 // 16))
+        print('.', end = '', flush = True)
+        if not shards.backlog or shards not in hub.congested_neighbors:
+            raise P2PTreeTestError()
+        shards.share_ancestors()
+        control = shards.backlog[-1]
+        hub.send_batch('x' for _ in range(node.HUB_BACKLOG_PACKETS))
+        counters = hub.metrics.snapshot()['counters']
+        print('.', end = '', flush = True)
+        if (len(shards.backlog) != node.HUB_BACKLOG_PACKETS or control not in shards.backlog or
+                counters['hub_dropped_packets_total'] != shards.dropped_packets or
+                shards.dropped_packets == 0):
+            raise P2PTreeTestError()
+        frames = []
+        await wait_until(lambda: frames.extend(shards.rings[0].read(1)) or (
+            not shards.backlog and shards not in hub.congested_neighbors))
+        print('.', end = '', flush = True)
+        if control not in frames:
+            raise P2PTreeTestError()
+        await hub.close()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(backlog())
+
+    async def scenario(shards: node.Shards) -> None:
+        received = {i: [] for i in range(9)}
+        hub = node.Node('H', ('localhost', 10020), on_message = received[8].append,
+                        shards = shards)
+        await hub.start()
+        clients = []
+        for i in range(8):
+            client = node.Node(f'C{i}', ('localhost', 10021 + i), ('localhost', 10020),
+                               on_message = received[i].append)
+            await client.start()
+            clients.append(client)
+        await wait_until(lambda: all(client.depth == 1 for client in clients))
+        await wait_until(lambda: hub.subtree == (9, 1))
+        print('.', end = '', flush = True)
+        clients[0].send('This is C0')
+        await wait_until(lambda: all(received[i] for i in range(9)))
+        for i in range(9):
+            verify_packet(received[i][0], 'This is C0')
+        for client in clients:
+            await client.close()
+        await hub.close()
+
+    shards = node.Shards(2)
+    with contextlib.redirect_stderr(io.StringIO()):
+        shards.spawn(functools.partial(node.hub_worker, 'H', ('localhost', 10020),
+                                       node.QueueLimits(), node.JoinPolicy(), None))
+        asyncio.run(scenario(shards))
+    if any(process.is_alive() for process in shards.processes):
+        raise P2PTreeTestError()
+
+def p2p_tree_test_18() -> None:
+    # a compressed message is relayed compressed to the nodes that read compressed frames,
+    # decompressed for a node that does not, and displayed the same everywhere
+    origin = node.Origin('A')
+    text = 'INFO request GET /index.html status=200 duration 12 ms ' * 4
+    packet = origin.make_message(text, compress = True)
+    print('.', end = '', flush = True)
+    if (packet.kind() != node.FRAME_COMPRESSED or len(packet.frame) >= len(text) or
+        packet.plain_length() != len(packet.plain())):
+        raise P2PTreeTestError()
+    verify_packet(packet, text)
+    print('.', end = '', flush = True)
+    if origin.make_message('short', compress = True).kind() != node.FRAME_MESSAGE:
+        raise P2PTreeTestError()
+    corrupt = node.Packet(packet.frame[:-8] + b'x' * 8)
+    verify_packet(corrupt, 'cannot be decompressed')
+    header = packet.frame[node.FRAME_HEADER.size:node.FRAME_HEADER.size + node.MESSAGE_HEADER.size + 1]
+    bomb = zlib.compress(b'x' * 1000000)[2:-4]  # raw deflate of far more than it claims
+    for claimed in (0, len(text)):  # a claimed length of 0 must not mean "no limit"
+        verify_packet(node.Packet(node.make_frame(node.FRAME_COMPRESSED, header +
+                                                  node.COMPRESSED_LENGTH.pack(claimed) + bomb)),
+                      'cannot be decompressed')
+
+    class OldNode(node.Node):  # does not announce that it reads compressed frames
+        def send_control(self, neighbor: node.Neighbor, control_type: int, body: dict) -> None:
+            if control_type != node.CONTROL_FEATURES:
+                super().send_control(neighbor, control_type, body)
+
+    async def scenario() -> None:
+        transport = node.MemoryTransport()
+        received = {name: [] for name in 'ABCD'}
+        a = node.Node('A', ('test', 0), on_message = received['A'].append, transport = transport,
+                      compression = True)
+        await a.start()
+        b = node.Node('B', ('test', 1), ('test', 0), on_message = received['B'].append,
+                      transport = transport)
+        await b.start()
+        c = OldNode('C', ('test', 2), ('test', 1), on_message = received['C'].append,
+                    transport = transport)
+        await c.start()
+        d = node.Node('D', ('test', 3), ('test', 1), on_message = received['D'].append,
+                      transport = transport)
+        await d.start()
+        await asyncio.sleep(0.1)
+        a.send(text)
+        await wait_until(lambda: all(received.values()))
+        print('.', end = '', flush = True)
+        if [received[name][0].kind() for name in 'ABCD'] != [
+                node.FRAME_COMPRESSED, node.FRAME_COMPRESSED, node.FRAME_MESSAGE,
+                node.FRAME_COMPRESSED]:
+            raise P2PTreeTestError()
+        print('.', end = '', flush = True)
+        if received['D'][0].frame != received['A'][0].frame:  # compressed once, by A
+            raise P2PTreeTestError()
+        for name in 'ABCD':
+            verify_packet(received[name][0], text)
+        to_c, to_d = sorted((neighbor for neighbor in b.neighbors if neighbor.child),
+                            key = lambda neighbor: neighbor.listen_address)
+        print('.', end = '', flush = True)
+        if (to_c.compression or not to_d.compression or to_c.compressed_bytes or
+            to_d.uncompressed_bytes <= to_d.compressed_bytes or to_c.decompress_seconds <= 0):
+            raise P2PTreeTestError()
+        print('.', end = '', flush = True)
+        if a.metrics.snapshot()['gauges']['compression_ratio'] <= 1:
+            raise P2PTreeTestError()
+        for n in (a, b, c, d):
+            await n.close()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(scenario())
+
+def p2p_tree_test_19() -> None:
+    # a hello for this connection switches it to frames, and one naming another port
+    # (relayed by a legacy node, or changed by a NAT) is logged and means a legacy peer
+    for hello_port, protocol in ((5000, node.PROTOCOL_FRAMED), (5001, node.PROTOCOL_LEGACY)):
+        sockets = socket.socketpair()
+        neighbor = node.Neighbor(sockets[0], ('test', 5000), node.QueueLimits())
+        sockets[1].sendall(node.make_handshake(node.HANDSHAKE_HELLO, hello_port))
+        with neighbor.read_buffer.free_space() as free_space:
+            received = sockets[0].recv_into(free_space)
+        neighbor.read_buffer.commit(received)
+        errors = io.StringIO()
+        with contextlib.redirect_stderr(errors):
+            neighbor.receive_packets()
+        for s in sockets:
+            s.close()
+        print('.', end = '', flush = True)
+        if neighbor.protocol != protocol or ('names port 5001' in errors.getvalue()) != (
+                protocol == node.PROTOCOL_LEGACY):
+            raise P2PTreeTestError()
+
+def p2p_tree_test_20() -> None:
+    # each queue policy changes the state of a neighbor above its high watermark:
+    # "backpressure" pauses the neighbors feeding it until it drains below its low watermark,
+    # "drop-newest" drops the new packets and "disconnect" marks it for disconnection
+    origin = node.Origin('A')
+    packets = [origin.make_message('x' * 100) for _ in range(10)]
+    states = {}
+    for policy in ('backpressure', 'drop-newest', 'disconnect'):
+        sockets = socket.socketpair()
+        neighbor = node.Neighbor(sockets[0], ('test', 0), node.QueueLimits(
+            high_packets = 4, low_packets = 2, policy = policy))
+        neighbor.negotiated(node.PROTOCOL_FRAMED)
+        for packet in packets:
+            neighbor.enqueue(packet)
+        states[policy] = (neighbor.queued_packets(), neighbor.dropped_packets,
+                          neighbor.congested, neighbor.overflowed)
+        if policy == 'backpressure':
+            states['sent'] = []
+            for count in (7, 1):  # as if sent: still above, then at the low watermark
+                neighbor.write_buffer.consume(len(packets[0].frame) * count)
+                neighbor.sent()
+                states['sent'].append((neighbor.queued_packets(), neighbor.congested))
+        for s in sockets:
+            s.close()
+    print('.', end = '', flush = True)
+    if states != {'backpressure': (10, 0, True, False), 'sent': [(3, True), (2, False)],
+                  'drop-newest': (4, 6, False, False), 'disconnect': (10, 0, False, True)}:
+        raise P2PTreeTestError()
+
+    async def scenario(policy: str) -> tuple[node.Node, node.Node, node.Node, list]:
+        # C reads slowly (by its rate limit), so B's queue for it fills up
+        transport = node.MemoryTransport()
+        received = []
+        a = node.Node('A', ('test', 0), on_message = lambda packet: None, transport = transport)
+        await a.start()
+        b = node.Node('B', ('test', 1), ('test', 0), node.QueueLimits(
+            256 * 1024, 128 * 1024, policy = policy), lambda packet: None, transport = transport)
+        await b.start()
+        c = node.Node('C', ('test', 2), ('test', 1), on_message = received.append,
+                      transport = transport, rate_limit = node.RateLimit(20000))
+        await c.start()
+        await wait_until(lambda: c.depth == 2)
+        a.send_batch('x' * 10000 for _ in range(100))
+        return a, b, c, received
+
+    async def backpressure() -> None:
+        a, b, c, received = await scenario('backpressure')
+        to_a = b.parent
+        await wait_until(lambda: b.congested_neighbors)
+        print('.', end = '', flush = True)
+        if to_a.events & selectors.EVENT_READ:  # B stopped reading from A
+            raise P2PTreeTestError()
+        c.rate_limit = None
+        c.unthrottle(c.parent)
+        await wait_until(lambda: len(received) == 100)
+        print('.', end = '', flush = True)
+        if b.congested_neighbors or not to_a.events & selectors.EVENT_READ or (
+                b.metrics.snapshot()['counters']['dropped_packets_total']):
+            raise P2PTreeTestError()
+        for n in (a, b, c):
+            await n.close()
+
+    async def disconnect() -> None:
+        a, b, c, received = await scenario('disconnect')
+        await wait_until(lambda: b.disconnect_counter == 1)
+        print('.', end = '', flush = True)
+        if len(b.neighbors) != 1 or b.neighbors[0] is not b.parent:
+            raise P2PTreeTestError()
+        for n in (a, b, c):
+            await n.close()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(backpressure())
+        asyncio.run(disconnect())
+
+def p2p_tree_test_21() -> None:
+    # a line longer than a frame is sent as several messages instead of dropping the links
+    async def test() -> None:
+        transport = node.MemoryTransport()
+        received = []
+        a = node.Node('A', ('test', 0), on_message = lambda packet: None, transport = transport)
+        await a.start()
+        b = node.Node('B', ('test', 1), ('test', 0), on_message = received.append,
+                      transport = transport)
+        await b.start()
+        await wait_until(lambda: b.depth == 1)
+        text = 'x' * (2 * 1024 * 1024)
+        a.send(text)
+        await wait_until(lambda: len(received) == 3)
+        print('.', end = '', flush = True)
+        offset = node.FRAME_HEADER.size + node.MESSAGE_HEADER.size + len(b'A')
+        if b''.join(packet.frame[offset:] for packet in received) != text.encode():
+            raise P2PTreeTestError()
+        print('.', end = '', flush = True)
+        if len(a.neighbors) != 1 or len(b.neighbors) != 1:
+            raise P2PTreeTestError()
+        for n in (a, b):
+            await n.close()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(test())
+
+def p2p_tree_test_22() -> None:
+    # both ends of an extra link know it is one, so plain text never travels it
+    async def test() -> None:
+        transport = node.MemoryTransport()
+        a = node.Node('A', ('test', 0), on_message = lambda packet: None, transport = transport)
+        await a.start()
+        b = node.Node('B', ('test', 1), ('test', 0), on_message = lambda packet: None,
+                      transport = transport, links = [('test', 0)])
+        await b.start()
+        await wait_until(lambda: b.depth == 1 and len(a.neighbors) == 2 and all(
+            neighbor.listen_address is not None for neighbor in a.neighbors))
+        print('.', end = '', flush = True)
+        if sorted(neighbor.extra for neighbor in a.neighbors) != [False, True] or (
+                sorted(neighbor.extra for neighbor in b.neighbors) != [False, True]):
+            raise P2PTreeTestError()
+        for n in (a, b):
+            await n.close()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(test())
+
 if __name__ == '__main__':
     global_dict = globals().copy()
     for k, v in global_dict.items():